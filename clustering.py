@@ -8,10 +8,26 @@ from itertools import compress
 import sys, os
 import pickle
 from visualization import TimeSeries, geographic_plot
-from validation import silhouette_plot, elbowPlot, plot_dendrogram
-
-
-def single_chemical_clustering(matrix=None, chemical=None, mode='kmeans', n_clusters=10, dbscan_eps=3, metric='euclidean', silhouette=False, verbose=True):
+from validation import silhouette_plot, elbowPlot, plot_dendrogram, sweep_metrics
+from cube_store import open_matrix
+from resampling import binned_nanmean, progress_bar, resample, load_dates, calendar_edges
+from pixel_index import OceanPixelIndex, cluster_sizes, float_labels
+from reduction import reduce_dimensions, fit_block_reducer, reducer_path, cached_reducer
+from merge_tree import MergeTree
+from density_clustering import NeighbourGraph
+from result_cache import memoize, fingerprint
+from regions import label_at, group_by_period
+
+# Files of the saved model data (see save_data.py), whose changes invalidate the cached results
+model_sources = ('model_data', 'model_data.npy', 'model_data.npz', 'datetimes.txt')
+
+# Number of pixels sampled for the silhouette score of the streamed clustering (see streaming_kmeans)
+streaming_silhouette_sample = 5000
+
+
+def single_chemical_clustering(matrix=None, chemical=None, mode='kmeans', n_clusters=10, dbscan_eps=3, metric='euclidean', silhouette=False, verbose=True,
+                               rows_per_block=8, batch_size=1024, n_epochs=1, silhouette_sample=None, n_components=None, reduction='pca',
+                               validate=True, neighbours=4, max_eps=None):
     '''
     This function clusters spatially the data of a certain chemical through time and returns the clustered data
     and the labels organized spatially.
@@ -23,76 +39,220 @@ def single_chemical_clustering(matrix=None, chemical=None, mode='kmeans', n_clus
                 1: DOXY
                 2: NITR
                 3: PHOS
-    mode:       clustering mode (kmeans, dbscan, hierarchical)
-    n_clusters: for kmeans and hierarchical, is the number of clusters
+    mode:       clustering mode (kmeans, dbscan, hierarchical, spatial_hierarchical, minibatch)
+                spatial_hierarchical only merges neighbouring pixels (see clustering)
+                minibatch streams blocks of pixels from the matrix (see streaming_kmeans),
+                so the memory used does not depend on the number of days or pixels
+    n_clusters: for kmeans, hierarchical and minibatch, is the number of clusters
     dbscan_eps: for dbscan, the maximal neighboring distance
     metric:     for dbscan, the metric used for distance calculations
     silhouette: plots the silohuette of the clusters (default False)
     verbose:    displays additional information while cluatering
+    validate:   if False the silhouette score is not computed (unless plotted) and s_avg is NaN
+    silhouette_sample: if not None, the silhouette is estimated on a stratified sample of this size
+                (for minibatch always on a sample, of streaming_silhouette_sample pixels if None)
+
+    rows_per_block, batch_size, n_epochs: for minibatch, see streaming_kmeans
+    n_components, reduction: optional reduction of the time series before clustering (see clustering;
+                for minibatch the projector is fitted on the streamed blocks, see streaming_kmeans)
+    neighbours: for spatial_hierarchical, 4 or 8 neighbouring pixels
+    max_eps:    for dbscan, if not None the neighbour graph is built (and cached) at this radius (see clustering)
     '''
     data = None
 
+    if chemical != None and chemical >= matrix.shape[3]:
+        print("Chemical Index not valid!")
+        return
+
+    if mode == 'minibatch':
+        return streaming_kmeans(matrix=matrix, chemical=chemical, n_clusters=n_clusters, rows_per_block=rows_per_block,
+                                batch_size=batch_size, n_epochs=n_epochs, silhouette_sample=silhouette_sample,
+                                silhouette=silhouette, verbose=verbose, validate=validate,
+                                n_components=n_components, reduction=reduction)
+
     if chemical == None:
         data = np.asarray(matrix)
     else:
-        if chemical >= matrix.shape[3]:
-            print("Chemical Index not valid!")
-            return
-        else:
-            data = matrix[:, :, :, chemical]
+        data = matrix[:, :, :, chemical]
 
     # Straighten-out data for clustering
-    straight_data = []
-    coordinates = []
-
-    for i in range(data.shape[1]):
-        for j in range(data.shape[2]):
-            if (~np.isnan(data[:, i, j])).all():
-                d = data[:, i, j].tolist()
-                coordinates.append([i, j])
-                straight_data.append(d)
-
-    straight_data = straight_data[1:]
+    index = OceanPixelIndex.from_series(data)
+    straight_data = index.series_to_features(data)
 
     # Clustering
     if mode == 'kmeans':
         clustered_data = clustering(
-            data=straight_data, n_clusters=n_clusters, mode='kmeans', verbose=verbose)
+            data=straight_data, n_clusters=n_clusters, mode='kmeans', verbose=verbose,
+            n_components=n_components, reduction=reduction)
     elif mode == 'dbscan':
         clustered_data = clustering(
-            data=straight_data, mode='dbscan', metric=metric, dbscan_epsilon=dbscan_eps, verbose=verbose)
+            data=straight_data, mode='dbscan', metric=metric, dbscan_epsilon=dbscan_eps, verbose=verbose,
+            n_components=n_components, reduction=reduction, max_eps=max_eps)
         n_clusters = max(clustered_data.labels_) + 1
     elif mode == 'hierarchical':
         clustered_data = clustering(
-            data=straight_data, n_clusters=n_clusters, mode='hierarchical', verbose=verbose)
+            data=straight_data, n_clusters=n_clusters, mode='hierarchical', verbose=verbose,
+            n_components=n_components, reduction=reduction)
+    elif mode == 'spatial_hierarchical':
+        clustered_data = clustering(
+            data=straight_data, n_clusters=n_clusters, mode='spatial_hierarchical', verbose=verbose,
+            n_components=n_components, reduction=reduction, connectivity=index.adjacency(neighbours))
 
-    cluster_sizes = [len(list(compress(straight_data, clustered_data.labels_ == i)))
-                     for i in range(n_clusters)]
+    sizes = cluster_sizes(clustered_data.labels_, n_clusters)
     if verbose:
         print("The " + str(n_clusters) + " cluster sizes are:")
-        print(cluster_sizes)
+        print(sizes)
 
     # Saving lables in a spatial martix
-    labels = np.full(data.shape[1:], np.nan)
-    straight_labels = np.full(len(straight_data), np.nan)
-
-    for i in range(len(straight_data)):
-        if clustered_data.labels_[i] >= 0:
-            labels[coordinates[i][0], coordinates[i][1]
-                   ] = clustered_data.labels_[i]
-            straight_labels[i] = clustered_data.labels_[i]
+    straight_labels = float_labels(clustered_data.labels_)
+    labels = index.to_grid(straight_labels)
 
     # Compute silhouette scores
-    s_avg = 0
-    s_avg = silhouette_plot(labels=straight_labels, data=straight_data,
-                            plotGraph=silhouette, n_clusters=n_clusters)
+    s_avg = np.nan
+    if validate or silhouette:
+        s_avg = silhouette_plot(labels=straight_labels, data=clustered_features(clustered_data, straight_data),
+                                plotGraph=silhouette, n_clusters=n_clusters, sample_size=silhouette_sample)
 
     del straight_data
 
-    return clustered_data, labels, cluster_sizes, s_avg
+    return clustered_data, labels, sizes, s_avg
+
+
+def pixel_blocks(matrix=None, chemical=None, rows_per_block=8):
+    '''
+    Reads the time series of the matrix in blocks of latitude rows.
+    Yields the row slice, the OceanPixelIndex of the valid pixels of the block and their
+    time series as a (n_valid, time) matrix.
+
+    matrix:         the data through time (time, lat, lon, chemical) or (time, lat, lon);
+                    it can be a lazily opened cube (see cube_store.open_matrix)
+    chemical:       index of the chemical, None if the matrix has a single chemical
+    rows_per_block: number of latitude rows read at once
+    '''
+    for i1 in range(0, matrix.shape[1], rows_per_block):
+        rows = slice(i1, min(i1 + rows_per_block, matrix.shape[1]))
+        if chemical == None:
+            block = matrix[:, rows, :]
+        else:
+            block = matrix[:, rows, :, chemical]
+        block = np.ma.filled(np.ma.asarray(block).astype(np.float64), np.nan)
+
+        index = OceanPixelIndex.from_series(block)
+        yield rows, index, index.series_to_features(block)
 
 
-def timestep_clustering(matrix=None, timestep=None, mode='kmeans', n_clusters=10, dbscan_eps=3, metric='euclidean', silhouette=False, verbose=True, **kwargs):
+def streaming_kmeans(matrix=None, chemical=None, n_clusters=10, rows_per_block=8, batch_size=1024, n_epochs=1,
+                     silhouette_sample=None, random_state=0, silhouette=False, verbose=True, validate=True,
+                     n_components=None, reduction='pca', reduction_batch_size=2048, cache_dir='reducers'):
+    '''
+    Clusters the full time series of every sea pixel of a chemical with a mini-batch kmeans.
+    The pixels are streamed from the matrix in blocks of rows twice: first to fit the
+    clusterer with partial_fit, then to label every pixel. Only one block is in memory
+    at a time. Returns the same output as single_chemical_clustering.
+
+    matrix:             the data through time, see pixel_blocks
+    chemical:           index of the chemical, None if the matrix has a single chemical
+    n_clusters:         number of clusters
+    rows_per_block:     number of latitude rows read at once
+    batch_size:         number of pixels per partial_fit call
+    n_epochs:           number of fitting passes over the data
+    silhouette_sample:  number of randomly sampled pixels used for the silhouette score
+                        (streaming_silhouette_sample if None)
+    random_state:       seed of the clusterer and of the sampling
+    silhouette:         plots the silohuette of the clusters (default False)
+    verbose:            displays additional information while cluatering
+    validate:           if False the silhouette score is not computed (unless plotted) and s_avg is NaN
+    n_components:       if not None, the time series are projected to n_components dimensions by a
+                        projector fitted in an additional first pass over the blocks (see
+                        reduction.fit_block_reducer), stored in the reducer_ attribute of the clusterer
+    reduction:          reduction method, 'pca' (incremental) or 'random' (random projection)
+    reduction_batch_size: number of pixels per batch of the incremental PCA
+    cache_dir:          directory of the cached projectors, keyed by the matrix (see
+                        result_cache.fingerprint), the blocks and the reduction parameters
+                        (None disables the cache)
+    '''
+    if verbose:
+        print("Starting the Clustering Procedure, using mode: minibatch")
+    if silhouette_sample is None:
+        silhouette_sample = streaming_silhouette_sample
+
+    reducer = None
+    if n_components is not None:
+        path = None
+        if cache_dir is not None:
+            path = reducer_path(cache_dir, fingerprint((matrix, chemical, rows_per_block)), n_components=n_components,
+                                method=reduction, batch_size=reduction_batch_size, random_state=random_state)
+        reducer = cached_reducer(path, lambda: fit_block_reducer(
+            (features for _, _, features in pixel_blocks(matrix, chemical, rows_per_block)), n_components=n_components,
+            method=reduction, batch_size=reduction_batch_size, random_state=random_state))
+
+    def blocks():
+        for rows, index, features in pixel_blocks(matrix, chemical, rows_per_block):
+            if reducer is not None:
+                features = reducer.transform(features) if index.n_valid > 0 else np.empty((0, n_components))
+            yield rows, index, features
+
+    clusterer = cluster.MiniBatchKMeans(
+        n_clusters=n_clusters, init='k-means++', batch_size=batch_size, random_state=random_state)
+
+    # Fitting pass(es), the pixels are buffered until there are enough for a batch
+    for epoch in range(n_epochs):
+        buffer = []
+        n_buffered = 0
+        for rows, index, features in blocks():
+            buffer.append(features)
+            n_buffered += len(features)
+            if n_buffered >= max(batch_size, n_clusters):
+                clusterer.partial_fit(np.concatenate(buffer))
+                buffer = []
+                n_buffered = 0
+        if n_buffered >= n_clusters or (n_buffered > 0 and hasattr(clusterer, 'cluster_centers_')):
+            clusterer.partial_fit(np.concatenate(buffer))
+
+    # Labelling pass, keeping a reservoir sample of the pixels for the silhouette score
+    rng = np.random.default_rng(random_state)
+    labels = np.full(matrix.shape[1:3], np.nan)
+    straight_labels = []
+    sample_keys = np.empty(0)
+    sample_data = np.empty((0, matrix.shape[0] if reducer is None else n_components))
+    sample_labels = np.empty(0, dtype=np.int64)
+    for rows, index, features in blocks():
+        if index.n_valid == 0:
+            continue
+        block_labels = clusterer.predict(features)
+        labels[rows] = index.to_grid(block_labels.astype(np.float64))
+        straight_labels.append(block_labels)
+
+        if not (validate or silhouette):
+            continue
+
+        # The pixels with the smallest random keys form a uniform sample
+        keys = np.concatenate((sample_keys, rng.random(index.n_valid)))
+        keep = keys.argsort()[:silhouette_sample]
+        sample_keys = keys[keep]
+        sample_data = np.concatenate((sample_data, features))[keep]
+        sample_labels = np.concatenate((sample_labels, block_labels))[keep]
+
+    clusterer.labels_ = np.concatenate(straight_labels)
+    if reducer is not None:
+        clusterer.reducer_ = reducer
+    sizes = cluster_sizes(clusterer.labels_, n_clusters)
+    if verbose:
+        print("Finished Clustering.")
+        print("The " + str(n_clusters) + " cluster sizes are:")
+        print(sizes)
+
+    # Compute silhouette scores on the sampled pixels
+    s_avg = np.nan
+    if validate or silhouette:
+        s_avg = silhouette_plot(labels=sample_labels, data=sample_data,
+                                plotGraph=silhouette, n_clusters=n_clusters)
+
+    return clusterer, labels, sizes, s_avg
+
+
+def timestep_clustering(matrix=None, timestep=None, mode='kmeans', n_clusters=10, dbscan_eps=3, metric='euclidean', silhouette=False, verbose=True,
+                        validate=True, silhouette_sample=None, neighbours=4, **kwargs):
     '''
     This function clusters spatially the data at a certain timestep and returns the clustered data
     and the labels organized spatially.
@@ -100,12 +260,17 @@ def timestep_clustering(matrix=None, timestep=None, mode='kmeans', n_clusters=10
     matrix:     the data through time or the data at a particular timestep
     timestep:   if None: the matrix is already given at a single timestep
                 if not None: it is the timestep to cluster
-    mode:       clustering mode (kmeans, dbscan, hierarchical)
+    mode:       clustering mode (kmeans, dbscan, hierarchical, spatial_hierarchical)
+                spatial_hierarchical only merges neighbouring pixels (see clustering); with
+                n_clusters=None the tree is cut at kwargs['distance_threshold']
     n_clusters: for kmeans and hierarchical, is the number of clusters
     dbscan_eps: for dbscan, the maximal neighboring distance
     metric:     for dbscan, the metric used for distance calculations
     silhouette: plots the silohuette of the clusters (default False)
     verbose:    displays additional information while cluatering
+    neighbours: for spatial_hierarchical, 4 or 8 neighbouring pixels
+    validate:   if False the silhouette score is not computed (unless plotted) and s_avg is NaN
+    silhouette_sample: if not None, the silhouette is estimated on a stratified sample of this size
     '''
     m_shape = len(matrix.shape)
     data = None
@@ -122,22 +287,8 @@ def timestep_clustering(matrix=None, timestep=None, mode='kmeans', n_clusters=10
                 data = matrix[timestep, :, :]
 
     # Straighten-out data for clustering
-    straight_data = []
-    coordinates = []
-
-    for i in range(data.shape[0]):
-        for j in range(data.shape[1]):
-            if m_shape == 4:
-                not_nan = ~np.isnan(data[i, j, :]).all()
-            else:
-                not_nan = not data.mask[i, j]
-            if not_nan:
-                if m_shape == 4:
-                    d = data[i, j, :].tolist()
-                else:
-                    d = [data[i, j], 0]
-                coordinates.append([i, j])
-                straight_data.append(d)
+    index = OceanPixelIndex.from_frame(data)
+    straight_data = index.frame_to_features(data)
 
     # Clustering
     if mode == 'kmeans':
@@ -150,34 +301,34 @@ def timestep_clustering(matrix=None, timestep=None, mode='kmeans', n_clusters=10
     elif mode == 'hierarchical':
         clustered_data = clustering(
             data=straight_data, n_clusters=n_clusters, mode='hierarchical', verbose=verbose, **kwargs)
+    elif mode == 'spatial_hierarchical':
+        clustered_data = clustering(
+            data=straight_data, n_clusters=n_clusters, mode='spatial_hierarchical', verbose=verbose,
+            connectivity=index.adjacency(neighbours), **kwargs)
+        n_clusters = clustered_data.n_clusters_
 
-    cluster_sizes = [len(list(compress(straight_data, clustered_data.labels_ == i)))
-                     for i in range(n_clusters)]
+    sizes = cluster_sizes(clustered_data.labels_, n_clusters)
     if verbose:
         print("The " + str(n_clusters) + " cluster sizes are:")
-        print(cluster_sizes)
+        print(sizes)
 
     # Saving lables in a spatial martix
-    labels = np.full(data.shape[0:2], np.nan)
-    straight_labels = np.full(len(straight_data), np.nan)
-
-    for i in range(len(straight_data)):
-        if clustered_data.labels_[i] >= 0:
-            labels[coordinates[i][0], coordinates[i][1]
-                   ] = clustered_data.labels_[i]
-            straight_labels[i] = clustered_data.labels_[i]
+    straight_labels = float_labels(clustered_data.labels_)
+    labels = index.to_grid(straight_labels)
 
     # Compute silhouette scores
-    s_avg = 0
-    s_avg = silhouette_plot(labels=straight_labels, data=straight_data,
-                            plotGraph=silhouette, n_clusters=n_clusters)
+    s_avg = np.nan
+    if validate or silhouette:
+        s_avg = silhouette_plot(labels=straight_labels, data=clustered_features(clustered_data, straight_data),
+                                plotGraph=silhouette, n_clusters=n_clusters, sample_size=silhouette_sample)
 
     del straight_data
 
-    return clustered_data, labels, cluster_sizes, s_avg
+    return clustered_data, labels, sizes, s_avg
 
 
-def timewise_clustering(matrix=None, location=None, chemicals=[True, True, True, True], mode='kmeans', n_clusters=10, dbscan_eps=3, metric='euclidean', silhouette=False, verbose=False, **kwargs):
+def timewise_clustering(matrix=None, location=None, chemicals=[True, True, True, True], mode='kmeans', n_clusters=10, dbscan_eps=3, metric='euclidean', silhouette=False, verbose=False,
+                        validate=True, silhouette_sample=None, **kwargs):
     '''
     This function clusters the data of the selected chemicals timewise 
     and returns the clustered data and the labels.
@@ -196,6 +347,9 @@ def timewise_clustering(matrix=None, location=None, chemicals=[True, True, True,
     metric:     for dbscan, the metric used for distance calculations
     silhouette: plots the silohuette of the clusters (default False)
     verbose:    displays additional information while clustering
+    validate:   if False the silhouette score is not computed (unless plotted) and s_avg is NaN
+    silhouette_sample: if not None, the silhouette is estimated on a stratified sample of this size
+    kwargs:     passed to clustering, e.g. n_components to reduce the dimensions first
     '''
     data = None
     if location != None:
@@ -231,143 +385,144 @@ def timewise_clustering(matrix=None, location=None, chemicals=[True, True, True,
 
     if not n_clusters is None:
 
-        cluster_sizes = [len(list(compress(straight_data, clustered_data.labels_ == i)))
-                         for i in range(n_clusters)]
+        sizes = cluster_sizes(clustered_data.labels_, n_clusters)
         if verbose:
             print("The " + str(n_clusters) + " cluster sizes are:")
-            print(cluster_sizes)
+            print(sizes)
 
         # Saving lables in a spatial martix
-        labels = np.full(len(straight_data), np.nan)
-
-        for i in range(len(straight_data)):
-            if clustered_data.labels_[i] >= 0:
-                labels[i] = clustered_data.labels_[i]
+        labels = float_labels(clustered_data.labels_)
 
         # Compute silhouette scores
-        s_avg = silhouette_plot(labels=labels, data=straight_data,
-                                plotGraph=silhouette, n_clusters=n_clusters)
+        s_avg = np.nan
+        if validate or silhouette:
+            s_avg = silhouette_plot(labels=labels, data=clustered_features(clustered_data, straight_data),
+                                    plotGraph=silhouette, n_clusters=n_clusters, sample_size=silhouette_sample)
     else:
         labels = []
-        cluster_sizes = []
+        sizes = []
         s_avg = []
 
     del straight_data
 
-    return clustered_data, labels, cluster_sizes, s_avg
+    return clustered_data, labels, sizes, s_avg
 
 
-def clustering(data=None, n_clusters=10, mode='kmeans', metric='euclidean', dbscan_epsilon=1, verbose=True, **kwargs):
+def clustering(data=None, n_clusters=10, mode='kmeans', metric='euclidean', dbscan_epsilon=1, verbose=True,
+               n_components=None, reduction='pca', **kwargs):
     '''
     This function clusters the received data according to the parameters given
 
-    data:       rectangular matrix to be clustered, shape=(n_samples, n_features)
-    mode:       clustering mode (kmeans, dbscan, hierarchical)
-    n_clusters: for kmeans and hierarchical, the number of clusters
-    dbscan_eps: for dbscan, the maximal neighboring distance
-    metric:     for dbscan, the metric used for distance calculations
+    data:           rectangular matrix to be clustered, shape=(n_samples, n_features)
+    mode:           clustering mode (kmeans, dbscan, hierarchical, spatial_hierarchical)
+                    spatial_hierarchical only merges samples connected in kwargs['connectivity'] (e.g. the
+                    grid adjacency, see pixel_index.OceanPixelIndex.adjacency). Its full merge tree is cached
+                    (see merge_tree.MergeTree), so other n_clusters or distance_threshold only cut it.
+    n_clusters:     for kmeans and hierarchical, the number of clusters
+    dbscan_eps:     for dbscan, the maximal neighboring distance
+    metric:         for dbscan, the metric used for distance calculations
+                    With kwargs['max_eps'], dbscan runs on the radius-neighbour graph built at max_eps and
+                    cached on disk (see density_clustering.NeighbourGraph), so other eps <= max_eps only
+                    filter it. The graph is stored in the graph_ attribute of the clusterer; graph_.sweep
+                    gives the labels of many eps at once.
+    n_components:   if not None, the samples are first projected to n_components dimensions
+                    (see reduction.reduce_dimensions). The projector and the reduced data are
+                    stored in the reducer_ and reduced_data_ attributes of the returned clusterer.
+    reduction:      reduction method, 'pca' (incremental) or 'random' (random projection)
     '''
     if verbose:
         print("Starting the Clustering Procedure, using mode: " + mode)
 
+    reducer = None
+    if n_components is not None:
+        data, reducer = reduce_dimensions(data, n_components=n_components, method=reduction)
+        if verbose:
+            print("Reduced the data to " + str(n_components) + " dimensions using " + reduction)
+
     if mode == 'kmeans':
+        kwargs.setdefault('init', 'k-means++')
         clusterer = cluster.KMeans(
-            n_clusters=n_clusters, init='k-means++', **kwargs)
+            n_clusters=n_clusters, **kwargs)
         clusterer.fit(data)
     elif mode == 'dbscan':
-        clusterer = cluster.DBSCAN(eps=dbscan_epsilon, metric=metric, **kwargs)
-        clusterer.fit(data)
+        max_eps = kwargs.pop('max_eps', None)
+        if max_eps is None:
+            clusterer = cluster.DBSCAN(eps=dbscan_epsilon, metric=metric, **kwargs)
+            clusterer.fit(data)
+        else:
+            graph = NeighbourGraph.build(data, max_eps=max_eps, metric=metric)
+            clusterer = graph.dbscan(eps=dbscan_epsilon, **kwargs)
+            clusterer.graph_ = graph
     elif mode == 'hierarchical':
         clusterer = cluster.AgglomerativeClustering(
             n_clusters=n_clusters, **kwargs)
         clusterer.fit(data)
+    elif mode == 'spatial_hierarchical':
+        clusterer = MergeTree.fit(data, connectivity=kwargs.get('connectivity'),
+                                  linkage=kwargs.get('linkage', 'ward'))
+        clusterer.cut(n_clusters=n_clusters, distance_threshold=kwargs.get('distance_threshold'))
+
+    if reducer is not None:
+        clusterer.reducer_ = reducer
+        clusterer.reduced_data_ = data
 
     if verbose:
         print("Finished Clustering.")
     return clusterer
 
 
-def average_data(matrix=None, delta_t=10):
+def clustered_features(clusterer, data):
     '''
-    This function averages the data through time
+    Returns the features the clusterer was fitted on: the reduced data if a dimensionality
+    reduction was used (see clustering), the given data otherwise
 
-    matrix:     data through time, space and chemicals
-    chemicals:  boolean array that represent which chemicals are being averaged;
-                as default, all of them are averaged
-    delta_t:    time period over which to average the data
+    clusterer:  clusterer returned by clustering
+    data:       data given to clustering
+    '''
+    return getattr(clusterer, 'reduced_data_', data)
+
+
+@memoize(ignore=('progress', 'chunk_size'), depends=('resampling', 'cube_store'))
+def average_data(matrix=None, delta_t=10, progress=None, chunk_size=366):
+    '''
+    This function averages the data through time, ignoring NaN (or masked) values
+
+    matrix:     data through time, space and chemicals (4D) or masked data through time and space (3D)
+    delta_t:    time period over which to average the data, can be fractional (e.g. 30.4325).
+                The bin t covers the time steps int(t*delta_t) to int((t+1)*delta_t) (excluded)
+    progress:   optional callback receiving the fraction of the work done (see resampling.progress_bar)
+    chunk_size: number of time steps read at once
+
+    The results are cached (see result_cache.memoize), keyed by the data (or the files of a saved
+    matrix) and delta_t.
     '''
-    m_shape = len(matrix.shape)
-    n_chemicals = matrix.shape[-1] if m_shape == 4 else 0
     time_steps = int(matrix.shape[0]/delta_t)
-    if m_shape == 4:
-        data = np.full(
-            (time_steps, matrix.shape[1], matrix.shape[2], matrix.shape[3]), np.nan)
+    edges = [int(t*delta_t) for t in range(time_steps)]
+    edges.append(min(int(time_steps*delta_t), matrix.shape[0]))
 
+    if progress is not None:
         print("Starting Averaging Procedure:")
-        sys.stdout.write("[%s]" % (" " * 10))
-        sys.stdout.flush()
-        sys.stdout.write("\b" * (10+1))
-        count = 0.1
-        for t in range(time_steps):
-            layer = np.zeros((matrix.shape[1], matrix.shape[2], n_chemicals))
-            for i in range(matrix.shape[1]):
-                for j in range(matrix.shape[2]):
-                    t1 = int(t*delta_t)
-                    t2 = int(min((t + 1)*delta_t, matrix.shape[0] - 1))
-                    for chem in range(n_chemicals):
-                        temp_data = matrix[t1:t2, i, j, chem]
-                        not_nan_indexes = ~np.isnan(temp_data)
-                        n_not_nans = sum(np.multiply(not_nan_indexes, 1))
-                        if n_not_nans > 0:
-                            d = np.sum(temp_data[not_nan_indexes])/n_not_nans
-                            layer[i, j, chem] = d
-                        else:
-                            layer[i, j, chem] = np.nan
-            data[t, :, :, :] = layer
-            if t / time_steps >= count:
-                sys.stdout.write(chr(9608))
-                sys.stdout.flush()
-                count += 0.1
-
-        sys.stdout.write(chr(9608))
-        sys.stdout.flush()
-        print("\nFinished Averaging.")
-
-        return data[:, :, :, :]
-    else:
-        data = np.full(
-            (time_steps, matrix.shape[1], matrix.shape[2]), np.nan)
 
-        print("Starting Averaging Procedure:")
-        sys.stdout.write("[%s]" % (" " * 10))
-        sys.stdout.flush()
-        sys.stdout.write("\b" * (10+1))
-        count = 0.1
-        for t in range(time_steps):
-            layer = np.zeros((matrix.shape[1], matrix.shape[2]))
-            for i in range(matrix.shape[1]):
-                for j in range(matrix.shape[2]):
-                    t1 = int(t*delta_t)
-                    t2 = int(min((t + 1)*delta_t, matrix.shape[0] - 1))
-                    temp_data = matrix[t1:t2, i, j]
-                    mask = ~temp_data.mask
-                    n_not_nans = sum(np.multiply(mask, 1))
-                    if n_not_nans > 0:
-                        d = np.sum(temp_data[mask])/n_not_nans
-                        layer[i, j] = d
-                    else:
-                        layer[i, j] = np.nan
-            data[t, :, :] = layer
-            if t / time_steps >= count:
-                sys.stdout.write(chr(9608))
-                sys.stdout.flush()
-                count += 0.1
-
-        sys.stdout.write(chr(9608))
-        sys.stdout.flush()
-        print("\nFinished Averaging.")
-
-        return data[:, :, :]
+    data = binned_nanmean(matrix, edges, chunk_size=chunk_size, progress=progress)
+
+    if progress is not None:
+        print("Finished Averaging.")
+
+    return data
+
+
+@memoize(sources=model_sources, depends=('resampling', 'cube_store'))
+def generate_monthly_data():
+    '''
+    Generates the monthly data, averaged over calendar months. The result is cached until the
+    saved model data changes (see model_sources).
+    '''
+    matrix = open_matrix('model_data')
+    av_matrix, _ = resample(matrix, load_dates('datetimes.txt'), freq='month', progress=progress_bar())
+
+    del matrix
+
+    return av_matrix
 
 
 def sort_clusters(labels=None, cluster_sizes=[]):
@@ -396,79 +551,49 @@ def clustervalues(labels, lons_lats, d, lon = 8.6865, lat = 54.025, chem = ['no3
     '''
     Function to plot the yearly mean of two cuantities of a certain cluster. The preset values correspong
     to the river estuary of the Elba, Weser and Rhine rivers.
+    The means are computed from the cached daily means of the clusters (see satellite.read_region_means
+    and regions.region_series).
 
-    matrix:     Matrix [timesteps, lons, lats, chem] containing the unmodified model values.
     labels:     Labels of the clustering algorithm.
     lons_lats:  Spatial coordinates of the form [:,:,0:1].
+    d:          Dates of the time steps of the model data.
     lon:        Longitude of a point within the cluster of interest.
     lat:        Latitude of a point within the cluster of interest.
     chems:      The chemicals that shall be plotted e.g. ['no3','po4']
     '''
     chems = list()
-    matrix = list()
-    from satellite import findClose, readSatData
+    means = list()
+    from satellite import read_region_means
+
+    label_estuary = label_at(labels, lons_lats[0, :, 0], lons_lats[:, 0, 1], lon, lat)
 
     for c in chem:
         if c == 'CHL' or c == 'chl' or c == 'Chl':
             chems.append(r'$Chl~[\frac{mg}{m^3}]$')
-            matrix.append(readSatData(os.path.abspath('MetO-NWS-BIO-dm-CHL.nc'))[0])
+            path = 'MetO-NWS-BIO-dm-CHL.nc'
         elif c == 'O2' or c == 'o2' or c == 'O_2':
             chems.append(r'$O_2~[\frac{mmol}{m^3}]$')
-            matrix.append(readSatData(os.path.abspath('MetO-NWS-BIO-dm-DOXY.nc'))[0])
+            path = 'MetO-NWS-BIO-dm-DOXY.nc'
         elif c == 'NO3' or c == 'no3' or c == 'no_3':
             chems.append(r'$NO_3~[\frac{mmol}{m^3}]$')
-            matrix.append(readSatData(os.path.abspath('MetO-NWS-BIO-dm-NITR.nc'))[0])
+            path = 'MetO-NWS-BIO-dm-NITR.nc'
         elif c == 'PO4' or c == 'po4' or c == 'po_4':
             chems.append(r'$PO_4~[\frac{mmol}{m^3}]$')
-            matrix.append(readSatData(os.path.abspath('MetO-NWS-BIO-dm-PHOS.nc'))[0])
-
-    
-    latEstuary = findClose(lons_lats[:,0,1], 54.025, end = 'min')
-    lonEstuary = findClose(lons_lats[0,:,0], 8.6865, end = 'min')
-
-    label_estuary = labels[latEstuary, lonEstuary]
-
-    n = len(d)
-    no3 = list()
-    po4 = list()
-    dates = [1998]
-    datesIdx = [1998]
-    years = np.array([date.year for date in d])
-    idx = np.where(labels == label_estuary)
-
-    rawNO3 = matrix[0]
-    rawPO4 = matrix[1]
-    meanNO3 = np.zeros(n)
-    meanPO4 = np.zeros(n)
-
-    for k in range(n):
-
-        datesIdx.append(d[k].year)
-
-        if int(dates[-1]) < d[k].year:
-            dates.append(d[k].year)
-
-        tmp = rawNO3[k]
-        meanNO3[k] = np.nanmean(tmp[idx])
-        tmp = rawPO4[k]
-        meanPO4[k] = np.nanmean(tmp[idx])
-
-    datesIdx.pop(-1)
-    datesIdx = np.array(datesIdx)
-
-    for k in dates:
-        no3.append(np.mean(meanNO3[np.where(datesIdx == k)]))
-        po4.append(np.mean(meanPO4[np.where(datesIdx == k)]))
+            path = 'MetO-NWS-BIO-dm-PHOS.nc'
+        else:
+            continue
+        daily = read_region_means(os.path.abspath(path), labels)
+        means.append(group_by_period(daily[:, int(label_estuary)], d, freq='year')[0])
 
-    no3 = np.array(no3)
-    po4 = np.array(po4)
+    years = calendar_edges(d, freq='year')[1].astype('datetime64[Y]').astype(int) + 1970
+    dates = years.tolist()
 
     fig, ax1 = plt.subplots(figsize = (8,6))
 
     color = 'tab:red'
     ax1.set_xlabel('Year', fontdict=dict(size=14))
     ax1.set_ylabel(chems[0], color=color, fontdict=dict(size=14))
-    ax1.plot(dates, no3, color=color)
+    ax1.plot(dates, means[0], color=color)
     ax1.tick_params(axis='y', labelcolor=color)
     ax1.set_xticks(dates[0::2])
     ax1.set_xticklabels(dates[0::2])
@@ -478,7 +603,7 @@ def clustervalues(labels, lons_lats, d, lon = 8.6865, lat = 54.025, chem = ['no3
 
     color = 'tab:blue'
     ax2.set_ylabel(chems[1], color=color, fontdict=dict(size=14))  # we already handled the x-label with ax1
-    ax2.plot(dates, po4, color = color)
+    ax2.plot(dates, means[1], color = color)
     ax2.tick_params(axis = 'y', labelcolor = color)
     ax2.set_title("Mean annual concentrations in the estuary cluster", fontdict=dict(color="black", size=14))
 
@@ -490,20 +615,13 @@ def clustervalues(labels, lons_lats, d, lon = 8.6865, lat = 54.025, chem = ['no3
 def main():
     # Loading already saved data (see save_data.py)
     print("Fetching data...")
-    #with np.load('model_data.npz') as m:
-    #    matrix = m['matrix']
     with open("datetimes.txt", "rb") as fp:   # Unpickling
         d = pickle.load(fp)
     with np.load('lons_lats.npz') as ll:
         lons_lats = ll['lons_lats']
 
-    # Average the data through time (if needed) and save it
-    av_matrix = average_data(matrix=matrix, delta_t=30.4325)
-    np.savez_compressed('av_model_data30.npz', matrix=av_matrix)
-
-    # Load average matrix if already saved
-    with np.load('av_model_data30.npz') as av_m:
-        av_matrix = av_m['matrix']
+    # Monthly average matrix (cached, see generate_monthly_data)
+    av_matrix = generate_monthly_data()
     print("Finished fetching data")
 
     # Clustering variables
@@ -522,32 +640,21 @@ def main():
     #     matrix=av_matrix, chemical=chem, mode="kmeans", n_clusters=n_clusters, silhouette=True)
 
     # clusterNumbers = np.arange(2, 15, 1)
-    # inertias = list()
-    # silhouette = list()
-
-    # for k in clusterNumbers:
-    #     cl, labels, cs, s_avg = timestep_clustering(
-    #         matrix=av_matrix, timestep=0, mode="kmeans", n_clusters=k, silhouette=False)
-    #     inertias.append(cl.inertia_)
-    #     silhouette.append(s_avg)
+    # frame = OceanPixelIndex.from_frame(av_matrix[0]).frame_to_features(av_matrix[0])
+    # models = [clustering(data=frame, n_clusters=k, mode='kmeans', verbose=False) for k in clusterNumbers]
+    # metrics = sweep_metrics(data=frame, models=models)
 
-    # plt.plot(clusterNumbers, silhouette)
+    # plt.plot(clusterNumbers, metrics['silhouette'])
     # plt.show()
 
-    # elbowPlot(inertiaVals=inertias, n_cluster=clusterNumbers)
+    # elbowPlot(inertiaVals=metrics['inertia'], n_cluster=clusterNumbers)
 
     # Clustering with hierarchical/agglomeratative
     #cl, labels, cs, s_avg = timewise_clustering(matrix=av_matrix, mode="hierarchical", n_clusters=None, silhouette=False, distance_threshold=0)
 
     #plot_dendrogram(cl, truncate_mode='level', p=5)
     from double_clustering import region_calculation
-    try:
-        with np.load('region_labels.npz') as r_labels:
-            region_labels = r_labels['matrix']
-    except:
-        region_labels = region_calculation(
-            n_regions=4, show_silhouette=True)
-        np.savez_compressed('region_labels.npz', matrix=region_labels)
+    region_labels = region_calculation(n_regions=4, show_silhouette=True)
 
     clustervalues(labels = region_labels, lons_lats = lons_lats, d = d, lon = 8.6865, lat = 54.025, chem = ['no3','po4'])
 
@@ -558,10 +665,11 @@ def main():
 
     # cl, labels, cs, s_avg = single_chemical_clustering(matrix=matrix, chemical=chem, mode="hierarchical", n_clusters=n_clusters)
 
-    # Clustering with dbscan (kinda shit)
-    # cl, labels, cs, s_avg = timestep_clustering(matrix=matrix, timestep=tstep, mode="dbscan", dbscan_eps=dbscan_eps)
+    # Clustering with dbscan, the neighbour graph is cached at max_eps so trying other eps is cheap
+    # cl, labels, cs, s_avg = timestep_clustering(matrix=matrix, timestep=tstep, mode="dbscan", dbscan_eps=dbscan_eps, max_eps=2)
     # cl, labels, cs, s_avg = single_chemical_clustering(
-    #     matrix=matrix, chemical=chem, mode="dbscan", dbscan_eps=dbscan_eps)
+    #     matrix=matrix, chemical=chem, mode="dbscan", dbscan_eps=dbscan_eps, max_eps=2)
+    # eps_labels = cl.graph_.sweep(np.arange(0.2, 2.2, 0.2))
 
 
 
@@ -0,0 +1,268 @@
+import os
+import json
+import zlib
+import itertools
+from collections import OrderedDict
+import numpy as np
+
+
+class ChunkedCube():
+    '''
+    On-disk data cube split in blocks of shape 'chunks' (e.g. time x lat x lon x chemical).
+
+    Without compression the cube is a single memory-mapped .npy file and slicing returns views
+    of it. With compression every block is stored in its own zlib compressed file, and slicing
+    only reads and decompresses the blocks it touches.
+
+    Opening a cube is lazy, data is only read when the cube is sliced:
+        cube = ChunkedCube('model_data')
+        frame = cube[50]
+        chl = cube[:, :, :, 0]
+    '''
+
+    def __init__(self, path, mode='r', cache_size=16):
+        '''
+        Opens an existing cube (see ChunkedCube.create for new ones)
+
+        path:       directory of the cube
+        mode:       'r' read only, 'r+' read and write
+        cache_size: number of decompressed blocks kept in memory
+        '''
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, 'meta.json'), 'r') as fp:
+            meta = json.load(fp)
+
+        self.shape = tuple(meta['shape'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.chunks = tuple(meta['chunks'])
+        self.compression = meta['compression']
+        self.level = meta['level']
+        self.fill_value = np.nan if meta['fill_value'] is None else meta['fill_value']
+
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+
+        if self.compression is None:
+            self._memmap = np.load(os.path.join(path, 'data.npy'),
+                                   mmap_mode='r' if mode == 'r' else 'r+')
+        else:
+            self._memmap = None
+
+    @classmethod
+    def create(cls, path, shape, dtype=np.float64, chunks=None, compression='zlib', level=4, fill_value=None):
+        '''
+        Creates an empty cube and returns it opened for writing
+
+        path:           directory of the cube (created if needed)
+        shape:          shape of the cube
+        dtype:          data type of the cube
+        chunks:         shape of the blocks; by default one time step and the whole frame
+        compression:    'zlib' or None (memory-mapped, not compressed)
+        level:          zlib compression level
+        fill_value:     value of the blocks never written (None means NaN)
+        '''
+        shape = tuple(int(s) for s in shape)
+        if chunks is None:
+            chunks = (1,) + shape[1:]
+        chunks = tuple(int(min(c, s)) if s > 0 else 1 for c, s in zip(chunks, shape))
+
+        os.makedirs(path, exist_ok=True)
+
+        # Statistics saved next to a previous cube are no longer valid
+        for f in os.listdir(path):
+            if f.startswith('stats') and f.endswith('.npz'):
+                os.remove(os.path.join(path, f))
+
+        if compression is None:
+            data = np.lib.format.open_memmap(os.path.join(path, 'data.npy'), mode='w+',
+                                             dtype=dtype, shape=shape)
+            data[...] = np.nan if fill_value is None else fill_value
+            data.flush()
+            del data
+        else:
+            os.makedirs(os.path.join(path, 'chunks'), exist_ok=True)
+
+        with open(os.path.join(path, 'meta.json'), 'w') as fp:
+            json.dump(dict(shape=shape, dtype=np.dtype(dtype).str, chunks=chunks,
+                           compression=compression, level=level, fill_value=fill_value), fp)
+
+        return cls(path, mode='r+')
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def __getitem__(self, key):
+        if self._memmap is not None:
+            return self._memmap[key]
+
+        indexes, squeeze = self._normalize_key(key)
+        out = np.empty(tuple(len(idx) for idx in indexes), dtype=self.dtype)
+
+        for chunk_index, local, position in self._touched_chunks(indexes):
+            out[np.ix_(*position)] = self._read_chunk(chunk_index)[np.ix_(*local)]
+
+        return out.reshape(tuple(n for n, s in zip(out.shape, squeeze) if not s))
+
+    def __setitem__(self, key, value):
+        if self.mode == 'r':
+            raise IOError("Cube opened in read only mode")
+        if self._memmap is not None:
+            self._memmap[key] = value
+            return
+
+        indexes, squeeze = self._normalize_key(key)
+        shape = tuple(len(idx) for idx in indexes)
+        target = tuple(n for n, s in zip(shape, squeeze) if not s)
+        value = np.broadcast_to(np.asarray(value, dtype=self.dtype), target).reshape(shape)
+
+        for chunk_index, local, position in self._touched_chunks(indexes):
+            whole = all(len(l) == self._chunk_shape(chunk_index)[axis]
+                        for axis, l in enumerate(local))
+            if whole:
+                block = np.ascontiguousarray(value[np.ix_(*position)])
+            else:
+                block = self._read_chunk(chunk_index).copy()
+                block[np.ix_(*local)] = value[np.ix_(*position)]
+            self._write_chunk(chunk_index, block)
+
+    def flush(self):
+        if self._memmap is not None and self.mode != 'r':
+            self._memmap.flush()
+
+    def iter_chunks(self, axis=0):
+        '''
+        Iterates over the cube in slabs of one block along the given axis.
+        Yields the slice of the slab and the data of the slab.
+
+        axis:   axis along which the cube is traversed
+        '''
+        step = self.chunks[axis]
+        for start in range(0, self.shape[axis], step):
+            key = [slice(None)] * self.ndim
+            key[axis] = slice(start, min(start + step, self.shape[axis]))
+            yield key[axis], self[tuple(key)]
+
+    def _normalize_key(self, key):
+        # Transforms a basic index into one array of indexes per axis
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            position = [i for i, k in enumerate(key) if k is Ellipsis][0]
+            key = key[:position] + (slice(None),) * (self.ndim - len(key) + 1) + key[position + 1:]
+        if len(key) > self.ndim:
+            raise IndexError("Too many indices for cube of dimension " + str(self.ndim))
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        indexes = []
+        squeeze = []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, slice):
+                indexes.append(np.arange(n)[k])
+                squeeze.append(False)
+            elif isinstance(k, (int, np.integer)):
+                if k < -n or k >= n:
+                    raise IndexError("Index " + str(k) + " out of bounds for axis with size " + str(n))
+                indexes.append(np.array([k % n]))
+                squeeze.append(True)
+            else:
+                raise IndexError("Cubes only support integer and slice indexing")
+        return indexes, squeeze
+
+    def _touched_chunks(self, indexes):
+        # Groups the requested indexes of every axis by block
+        per_axis = []
+        for idx, c in zip(indexes, self.chunks):
+            groups = []
+            block = idx // c
+            for b in np.unique(block):
+                position = np.nonzero(block == b)[0]
+                groups.append((int(b), idx[position] - b * c, position))
+            per_axis.append(groups)
+
+        for combination in itertools.product(*per_axis):
+            yield tuple(g[0] for g in combination), [g[1] for g in combination], [g[2] for g in combination]
+
+    def _chunk_shape(self, chunk_index):
+        return tuple(min(c, s - i * c) for i, c, s in zip(chunk_index, self.chunks, self.shape))
+
+    def _chunk_path(self, chunk_index):
+        return os.path.join(self.path, 'chunks', '.'.join(str(i) for i in chunk_index))
+
+    def _read_chunk(self, chunk_index):
+        if chunk_index in self._cache:
+            self._cache.move_to_end(chunk_index)
+            return self._cache[chunk_index]
+
+        path = self._chunk_path(chunk_index)
+        if os.path.exists(path):
+            with open(path, 'rb') as fp:
+                block = np.frombuffer(zlib.decompress(fp.read()), dtype=self.dtype)
+            block = block.reshape(self._chunk_shape(chunk_index))
+        else:
+            block = np.full(self._chunk_shape(chunk_index), self.fill_value, dtype=self.dtype)
+
+        self._cache[chunk_index] = block
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return block
+
+    def _write_chunk(self, chunk_index, block):
+        with open(self._chunk_path(chunk_index), 'wb') as fp:
+            fp.write(zlib.compress(block.tobytes(), self.level))
+        self._cache.pop(chunk_index, None)
+
+
+def is_cube(path):
+    '''
+    Returns True if path is the directory of a ChunkedCube
+    '''
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+def save_cube(path, matrix, chunks=None, compression='zlib', level=4):
+    '''
+    Saves a matrix as a ChunkedCube and returns the opened cube
+
+    path:           directory of the cube
+    matrix:         data to save
+    chunks:         shape of the blocks (see ChunkedCube.create)
+    compression:    'zlib' or None
+    level:          zlib compression level
+    '''
+    matrix = np.asarray(matrix)
+    cube = ChunkedCube.create(path, matrix.shape, dtype=matrix.dtype, chunks=chunks,
+                              compression=compression, level=level)
+    for t1 in range(0, matrix.shape[0], cube.chunks[0]):
+        t2 = min(t1 + cube.chunks[0], matrix.shape[0])
+        cube[t1:t2] = matrix[t1:t2]
+    cube.flush()
+    return ChunkedCube(path)
+
+
+def open_matrix(name):
+    '''
+    Opens a saved matrix without loading it. In order of preference the name can refer to a
+    ChunkedCube directory, a name.npy file (memory-mapped) or a name.npz file (legacy format,
+    loaded in memory).
+
+    name:   name of the matrix, e.g. 'model_data' or 'av_model_data30'
+    '''
+    if is_cube(name):
+        return ChunkedCube(name)
+    if os.path.exists(name + '.npy'):
+        return np.load(name + '.npy', mmap_mode='r')
+    with np.load(name + '.npz') as m:
+        return m['matrix']
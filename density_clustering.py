@@ -0,0 +1,153 @@
+import os
+import numpy as np
+import sklearn.cluster as cluster
+from scipy import sparse
+from scipy.sparse import csgraph
+from sklearn.neighbors import NearestNeighbors
+from reduction import data_key
+
+
+class NeighbourGraph():
+    '''
+    Radius-neighbour graph of the samples, built once with a ball tree at the largest eps of
+    interest (max_eps) and cached on disk. DBSCAN for any eps <= max_eps is then answered from
+    the graph instead of recomputing the neighbourhoods:
+
+        graph = NeighbourGraph.build(data, max_eps=1.0)
+        model = graph.dbscan(eps=0.5)                       # sklearn DBSCAN on the cached graph
+        labels = graph.sweep([0.2, 0.4, 0.6, 0.8])          # many eps from one reachability tree
+    '''
+
+    def __init__(self, graph, max_eps):
+        '''
+        graph:      sparse (n_samples, n_samples) matrix of the distances smaller than max_eps,
+                    with the rows sorted by distance
+        max_eps:    radius of the graph
+        '''
+        self.graph = graph.tocsr()
+        self.max_eps = max_eps
+        self.n_samples = self.graph.shape[0]
+        self._trees = dict()
+
+    @classmethod
+    def build(cls, data, max_eps=1, metric='euclidean', algorithm='ball_tree', cache_dir='neighbour_graphs'):
+        '''
+        Builds the radius-neighbour graph of the data, or loads it from cache_dir
+
+        data:       matrix of shape (n_samples, n_features)
+        max_eps:    largest eps of interest
+        metric:     distance metric
+        algorithm:  neighbour search structure (ball_tree, kd_tree)
+        cache_dir:  directory of the cached graphs (None disables the cache)
+        '''
+        data = np.asarray(data, dtype=np.float64)
+
+        path = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, data_key(data, max_eps=max_eps, metric=metric) + '.npz')
+            if os.path.exists(path):
+                return cls(sparse.load_npz(path), max_eps)
+
+        neighbours = NearestNeighbors(radius=max_eps, metric=metric, algorithm=algorithm).fit(data)
+        graph = neighbours.radius_neighbors_graph(mode='distance', sort_results=True)
+
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            sparse.save_npz(path, graph)
+
+        return cls(graph, max_eps)
+
+    def dbscan(self, eps=None, min_samples=5, **kwargs):
+        '''
+        Runs sklearn's DBSCAN on the cached graph and returns the fitted model
+
+        eps:            maximal neighbouring distance, at most max_eps (default max_eps)
+        min_samples:    number of samples in a neighbourhood for a point to be a core point
+        '''
+        eps = self.max_eps if eps is None else eps
+        if eps > self.max_eps:
+            raise ValueError("eps (" + str(eps) + ") is larger than the radius of the graph (" + str(self.max_eps) + ")")
+        return cluster.DBSCAN(eps=eps, min_samples=min_samples, metric='precomputed', **kwargs).fit(self.graph)
+
+    def core_distances(self, min_samples=5):
+        '''
+        Returns the smallest eps at which every sample is a core point (inf above max_eps)
+
+        min_samples:    number of samples in a neighbourhood (the sample included)
+        '''
+        k = min_samples - 1
+        if k <= 0:
+            return np.zeros(self.n_samples)
+        row_lengths = np.diff(self.graph.indptr)
+        core = np.full(self.n_samples, np.inf)
+        enough = row_lengths >= k
+        core[enough] = self.graph.data[self.graph.indptr[:-1][enough] + k - 1]
+        return core
+
+    def reachability_tree(self, min_samples=5):
+        '''
+        Returns the core distances and the minimum spanning tree of the mutual reachability
+        distances max(d(i, j), core(i), core(j)). Cutting the tree at eps gives the DBSCAN clusters
+        of the core points for that eps (OPTICS-style extraction). The tree is kept in memory.
+
+        min_samples:    number of samples in a neighbourhood (the sample included)
+        '''
+        if min_samples not in self._trees:
+            core = self.core_distances(min_samples)
+            graph = self.graph.tocoo()
+            weights = np.maximum(graph.data, np.maximum(core[graph.row], core[graph.col]))
+            finite = np.isfinite(weights)
+            # Zero weights would be dropped by the sparse graph routines
+            reachability = sparse.coo_matrix((weights[finite] + np.finfo(np.float64).tiny,
+                                              (graph.row[finite], graph.col[finite])), shape=graph.shape)
+            tree = csgraph.minimum_spanning_tree(reachability.tocsr()).tocoo()
+            self._trees[min_samples] = (core, tree)
+        return self._trees[min_samples]
+
+    def labels(self, eps=None, min_samples=5):
+        '''
+        Returns the DBSCAN labels for the given eps from the reachability tree (noise is -1).
+        Border points join the cluster of their nearest core point; the clusters are numbered in
+        the order of their first sample, as in sklearn.
+
+        eps:            maximal neighbouring distance, at most max_eps (default max_eps)
+        min_samples:    number of samples in a neighbourhood (the sample included)
+        '''
+        eps = self.max_eps if eps is None else eps
+        if eps > self.max_eps:
+            raise ValueError("eps (" + str(eps) + ") is larger than the radius of the graph (" + str(self.max_eps) + ")")
+        core, tree = self.reachability_tree(min_samples)
+        is_core = core <= eps
+
+        # Clusters of the core points
+        kept = tree.data <= eps
+        links = sparse.coo_matrix((np.ones(np.sum(kept)), (tree.row[kept], tree.col[kept])), shape=tree.shape)
+        components = csgraph.connected_components(links, directed=False)[1]
+        labels = np.where(is_core, components, -1)
+
+        # Border points: nearest core point within eps
+        graph = self.graph.tocoo()
+        candidate = (graph.data <= eps) & is_core[graph.col] & ~is_core[graph.row]
+        rows, cols, distances = graph.row[candidate], graph.col[candidate], graph.data[candidate]
+        order = np.lexsort((distances, rows))
+        rows, cols = rows[order], cols[order]
+        first = np.r_[True, rows[1:] != rows[:-1]] if len(rows) > 0 else np.zeros(0, dtype=bool)
+        labels[rows[first]] = labels[cols[first]]
+
+        # Renumber the clusters in the order of their first sample
+        clustered = labels >= 0
+        unique, first_index, inverse = np.unique(labels[clustered], return_index=True, return_inverse=True)
+        rank = np.empty(len(unique), dtype=np.int64)
+        rank[np.argsort(first_index)] = np.arange(len(unique))
+        labels[clustered] = rank[inverse]
+
+        return labels
+
+    def sweep(self, eps_values, min_samples=5):
+        '''
+        Returns a dictionary with the DBSCAN labels of every eps (see labels)
+
+        eps_values:     maximal neighbouring distances, at most max_eps
+        min_samples:    number of samples in a neighbourhood (the sample included)
+        '''
+        return {eps: self.labels(eps, min_samples) for eps in eps_values}
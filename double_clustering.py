@@ -1,60 +1,175 @@
 import numpy as np
 from scipy import stats
-from clustering import average_data, timestep_clustering, sort_clusters, clustering
+from clustering import average_data, timestep_clustering, sort_clusters, clustering, generate_monthly_data, model_sources
 from visualization import geographic_plot, timeseries_plot, timeClustersVisualization
 import matplotlib.pyplot as plt
 from itertools import compress
 from validation import silhouette_plot
+from pixel_index import cluster_sizes
 import pickle
+from cube_store import open_matrix
+from resampling import progress_bar, resample, load_dates, calendar_edges
+from parallel import share_array, attach_worker, worker_arrays
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from result_cache import memoize
+from regions import region_means
 
 
+@memoize(sources=model_sources, depends=('resampling', 'cube_store'))
 def generate_yearly_data():
     '''
-    Generates the yearly data
+    Generates the yearly data, averaged over calendar years. The result is cached until the
+    saved model data changes (see clustering.model_sources).
     '''
-    with np.load('model_data.npz') as m:
-        matrix = m['matrix']
-    av_matrix = average_data(matrix=matrix, delta_t=366)
-    np.savez_compressed('av_model_dataYearly.npz', matrix=av_matrix)
+    matrix = open_matrix('model_data')
+    av_matrix, _ = resample(matrix, load_dates('datetimes.txt'), freq='year', progress=progress_bar())
 
     del matrix
 
     return av_matrix
 
 
-def region_calculation(n_regions=4, show_silhouette=True):
+def cluster_shared_timestep(timestep, n_regions, validate=True):
     '''
-    Generates the regions
+    Pool task of timesteps_clustering: clusters one timestep of the shared averaged matrix.
+    Returns the timestep, its labels sorted by cluster size and the silhouette score.
 
-    n_regions:          number of regions
-    show_silhouette:    default True
+    timestep:   timestep to cluster
+    n_regions:  number of regions
+    validate:   if False the silhouette score is not computed (NaN)
     '''
+    av_matrix = worker_arrays['av_matrix'][1]
+    cl, labels, cl_sizes, s_avg = timestep_clustering(
+        matrix=av_matrix, timestep=timestep, mode="kmeans", n_clusters=n_regions, silhouette=False, verbose=False, validate=validate)
+    return timestep, sort_clusters(labels=labels, cluster_sizes=cl_sizes), s_avg
 
-    # Loading data
-    try:
-        with np.load('av_model_dataYearly.npz') as av_m:
-            av_matrix = av_m['matrix']
-    except:
-        av_matrix = generate_yearly_data()
-
-    with np.load('lons_lats.npz') as ll:
-        lons_lats = ll['lons_lats']
 
-    # Running clustering algorithms
+def timesteps_clustering(av_matrix=None, n_regions=4, n_workers=None, warm_start=False, validate=True):
+    '''
+    Clusters every timestep of the averaged matrix with kmeans.
+    Returns the labels of every timestep, shape (time, lat, lon), and their silhouette scores.
+
+    av_matrix:  averaged data matrix (time, lat, lon, chemical)
+    n_regions:  number of regions
+    n_workers:  number of worker processes; the timesteps are clustered in parallel over a
+                shared-memory copy of av_matrix (None uses all cores, 1 runs serially)
+    warm_start: if True, the kmeans of every timestep starts from the centroids of the previous
+                one (serially). The labels keep their identity through time and are sorted by the
+                cluster sizes of the first timestep.
+    validate:   if False the silhouette scores are not computed (NaN)
+    '''
+    av_matrix = np.asarray(av_matrix)
     labels = np.full(av_matrix.shape[:-1], np.nan)
     silhouette_scores = np.full(av_matrix.shape[0], np.nan)
-    for i in range(av_matrix.shape[0]):
-        cl, labels[i, :, :], cl_sizes, silhouette_scores[i] = timestep_clustering(
-            matrix=av_matrix, timestep=i, mode="kmeans", n_clusters=n_regions, silhouette=False, verbose=False)
-        labels[i, :, :] = sort_clusters(
-            labels=labels[i, :, :], cluster_sizes=cl_sizes)
 
-    region_labels = np.full(labels.shape[1:], np.nan)
+    if warm_start:
+        centers = None
+        first_sizes = None
+        for i in range(av_matrix.shape[0]):
+            if centers is None:
+                kwargs = dict()
+            else:
+                kwargs = dict(init=centers, n_init=1)
+            cl, labels[i, :, :], cl_sizes, silhouette_scores[i] = timestep_clustering(
+                matrix=av_matrix, timestep=i, mode="kmeans", n_clusters=n_regions, silhouette=False, verbose=False, validate=validate, **kwargs)
+            centers = cl.cluster_centers_
+            if first_sizes is None:
+                first_sizes = cl_sizes
+            labels[i, :, :] = sort_clusters(
+                labels=labels[i, :, :], cluster_sizes=first_sizes)
+    elif n_workers == 1:
+        for i in range(av_matrix.shape[0]):
+            cl, labels[i, :, :], cl_sizes, silhouette_scores[i] = timestep_clustering(
+                matrix=av_matrix, timestep=i, mode="kmeans", n_clusters=n_regions, silhouette=False, verbose=False, validate=validate)
+            labels[i, :, :] = sort_clusters(
+                labels=labels[i, :, :], cluster_sizes=cl_sizes)
+    else:
+        shm, descriptor = share_array(av_matrix)
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=attach_worker,
+                                     initargs=(dict(av_matrix=descriptor),)) as pool:
+                tasks = [pool.submit(cluster_shared_timestep, i, n_regions, validate)
+                         for i in range(av_matrix.shape[0])]
+                for task in as_completed(tasks):
+                    i, labels[i, :, :], silhouette_scores[i] = task.result()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    return labels, silhouette_scores
+
+
+def label_consensus(labels=None, n_labels=None):
+    '''
+    Computes the most frequent label of every pixel through time (ties go to the smallest label).
+    Returns the consensus labels, shape (lat, lon), and the fraction of timesteps agreeing with it.
+    NaN labels are ignored; pixels that are NaN at every timestep are NaN in both outputs.
+
+    labels:     labels of every timestep, shape (time, lat, lon)
+    n_labels:   number of different labels (default: largest label + 1)
+    '''
+    labels = np.asarray(labels, dtype=np.float64)
+    valid = ~np.isnan(labels)
+    if n_labels is None:
+        n_labels = int(np.nanmax(labels)) + 1 if valid.any() else 0
+
+    # Number of timesteps with every label, one label at a time to keep memory at (lat, lon) per label
+    counts = np.zeros((n_labels,) + labels.shape[1:], dtype=np.int64)
+    for k in range(n_labels):
+        counts[k] = np.sum(labels == k, axis=0)
+
+    n_valid = np.sum(valid, axis=0)
+    consensus = np.argmax(counts, axis=0).astype(np.float64) if n_labels > 0 else np.zeros(labels.shape[1:])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        agreement = np.max(counts, axis=0, initial=0) / n_valid
+
+    consensus[n_valid == 0] = np.nan
+    agreement[n_valid == 0] = np.nan
+
+    return consensus, agreement
+
+
+@memoize(ignore=('n_workers',), sources=model_sources,
+         depends=('double_clustering', 'clustering', 'pixel_index', 'validation', 'resampling', 'cube_store'))
+def compute_regions(n_regions=4, n_workers=None, warm_start=False):
+    '''
+    Clusters the yearly data (see timesteps_clustering) and computes the regions as the consensus of
+    the yearly labels (see label_consensus). Returns the region labels, the silhouette scores of
+    the years and the agreement of the yearly labels with the regions.
+    The results are cached until the parameters, the code or the saved model data change.
+
+    n_regions:          number of regions
+    n_workers:          number of processes clustering the years in parallel (see timesteps_clustering)
+    warm_start:         seeds every year with the centroids of the previous one (see timesteps_clustering)
+    '''
+
+    # Loading data
+    av_matrix = generate_yearly_data()
+
+    # Running clustering algorithms
+    labels, silhouette_scores = timesteps_clustering(
+        av_matrix=av_matrix, n_regions=n_regions, n_workers=n_workers, warm_start=warm_start)
 
     # Computing regions
-    for i in range(region_labels.shape[0]):
-        for j in range(region_labels.shape[1]):
-            region_labels[i, j] = stats.mode(labels[:, i, j])[0]
+    region_labels, agreement = label_consensus(labels, n_labels=n_regions)
+
+    return region_labels, silhouette_scores, agreement
+
+
+def region_calculation(n_regions=4, show_silhouette=True, n_workers=None, warm_start=False):
+    '''
+    Generates the regions (cached, see compute_regions) and plots them
+
+    n_regions:          number of regions
+    show_silhouette:    default True
+    n_workers:          number of processes clustering the years in parallel (see timesteps_clustering)
+    warm_start:         seeds every year with the centroids of the previous one (see timesteps_clustering)
+    '''
+    region_labels, silhouette_scores, agreement = compute_regions(
+        n_regions=n_regions, n_workers=n_workers, warm_start=warm_start)
+
+    with np.load('lons_lats.npz') as ll:
+        lons_lats = ll['lons_lats']
 
     # Plotting results
     geographic_plot(data=region_labels,
@@ -64,6 +179,7 @@ def region_calculation(n_regions=4, show_silhouette=True):
     print(silhouette_scores)
 
     print('Silhouette Average: ', np.mean(silhouette_scores))
+    print('Mean agreement of the yearly labels with the regions: ', np.nanmean(agreement))
     if show_silhouette:
         plt.hist(silhouette_scores)
         plt.show()
@@ -73,7 +189,8 @@ def region_calculation(n_regions=4, show_silhouette=True):
 
 def average_by_region(matrix=None, chemical=0, r_labels=None, n_regions=4):
     '''
-    Generates the data for a single chemical taking average by region (see region_calculation)
+    Generates the data for a single chemical taking average by region (see region_calculation).
+    The averages of all the chemicals are computed at once and cached (see regions.region_means).
 
     matrix:     data matrix
     chemical:   0: CHL
@@ -83,74 +200,48 @@ def average_by_region(matrix=None, chemical=0, r_labels=None, n_regions=4):
     r_labels:   region labels, different number for different region
     n_regiond:  number of regions
     '''
-    data = np.full((matrix.shape[0], n_regions), np.nan)
-
-    for i in range(matrix.shape[0]):
-        d = [[0, 0]] * n_regions
-        for j in range(r_labels.shape[0]):
-            for k in range(r_labels.shape[1]):
-                if not np.isnan(r_labels[j][k]):
-                    d[int(r_labels[j, k])][0] += matrix[i, j, k, chemical]
-                    d[int(r_labels[j, k])][1] += 1
-        for region in range(n_regions):
-            data[i, region] = d[region][0] / d[region][1]
-
-    return data
+    return region_means(matrix, r_labels, n_regions=n_regions)[:, :, chemical]
 
 
 # Example application of the above functions
 def main():
     n_regions = 4
 
-    # Loading region data and calculate them if not saved
-    try:
-        with np.load('region_labels.npz') as r_labels:
-            region_labels = r_labels['matrix']
-    except:
-        region_labels = region_calculation(
-            n_regions=n_regions, show_silhouette=True)
-        np.savez_compressed('region_labels.npz', matrix=region_labels)
+    # Loading region data (cached, see region_calculation)
+    region_labels = region_calculation(n_regions=n_regions, show_silhouette=True)
 
     print('Fetching Data...')
-    with np.load('av_model_data30.npz') as m:
-        av_matrix = m['matrix']
-    with open("datetimes.txt", "rb") as fp:
-        dates = pickle.load(fp)
+    dates = load_dates('datetimes.txt')
+    av_matrix = generate_monthly_data()
     print('Finished Fetching Data')
 
     # Clustering parameters
     mode = 'kmeans'
     n_clusters = [2, 3, 4] # Comparing results with 2, 3, and 4 temporal clusters
 
-    data = []
+    # Average of every region, chemical and month
+    data = region_means(av_matrix, region_labels, n_regions=n_regions)
     s_avg = []
 
-    # Keeping relevant dates
-    new_d = []
-    for i in range(int(len(dates)/30.4325)):
-        new_d.append(dates[int(i * 30.4325)])
+    # First day of every month
+    new_d = calendar_edges(dates, freq='month')[1].tolist()
 
     # Clustering with regional average by chemical
     for i in range(4):
         for n in n_clusters:
-            data.append(average_by_region(matrix=av_matrix, chemical=i,
-                                          r_labels=region_labels, n_regions=n_regions))
-
             # Clustering
             if mode == 'kmeans':
                 clustered_data = clustering(
-                    data=data[i], n_clusters=n, mode='kmeans', verbose=False)
+                    data=data[:, :, i], n_clusters=n, mode='kmeans', verbose=False)
             elif mode == 'hierarchical':
                 clustered_data = clustering(
-                    data=data[i], n_clusters=n, mode='hierarchical', verbose=False)
+                    data=data[:, :, i], n_clusters=n, mode='hierarchical', verbose=False)
 
             print("The " + str(n) + " cluster sizes are:")
-            cluster_sizes = [len(list(compress(data[i], clustered_data.labels_ == cluster)))
-                             for cluster in range(n)]
-            print(cluster_sizes)
+            print(cluster_sizes(clustered_data.labels_, n))
 
             s_avg.append(silhouette_plot(labels=clustered_data.labels_,
-                                         data=data[i], plotGraph=False, n_clusters=n))
+                                         data=data[:, :, i], plotGraph=False, n_clusters=n))
 
             # Two different ways of visualizing the results
             timeseries_plot(data=clustered_data.labels_, t=new_d)
@@ -0,0 +1,188 @@
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from parallel import share_array, attach_worker, worker_arrays
+
+
+def window_mean(block, k=1):
+    '''
+    Fills the NaN values of a block with the mean of the valid values of the same pixel in the
+    window of +-k time steps. Only the values of the block are used, never filled ones, so the
+    result does not depend on the order of the time steps.
+
+    block:  data of shape (time, lat, lon) with NaN for the gaps
+    k:      half width of the window in time steps
+    '''
+    valid = ~np.isnan(block)
+    zeros = np.zeros((1,) + block.shape[1:])
+    sums = np.concatenate((zeros, np.cumsum(np.where(valid, block, 0), axis=0)))
+    counts = np.concatenate((zeros, np.cumsum(valid, axis=0)))
+
+    steps = np.arange(block.shape[0])
+    end = np.minimum(steps + k + 1, block.shape[0])
+    start = np.maximum(steps - k, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (sums[end] - sums[start]) / (counts[end] - counts[start])
+    return np.where(valid, block, means)
+
+
+def linear_fill(block, k=1):
+    '''
+    Fills the NaN values of a block by linear interpolation in time between the previous and the
+    next valid values of the same pixel, if both are at most k time steps away
+
+    block:  data of shape (time, lat, lon) with NaN for the gaps
+    k:      largest distance in time steps to the valid values
+    '''
+    n_steps = block.shape[0]
+    valid = ~np.isnan(block)
+    steps = np.broadcast_to(np.arange(n_steps).reshape((-1,) + (1,) * (block.ndim - 1)), block.shape)
+
+    # Time step of the previous and of the next valid value of every value
+    previous = np.maximum.accumulate(np.where(valid, steps, -1), axis=0)
+    following = np.minimum.accumulate(np.where(valid, steps, n_steps)[::-1], axis=0)[::-1]
+    fill = ~valid & (previous >= 0) & (following < n_steps) & (steps - previous <= k) & (following - steps <= k)
+
+    before = np.take_along_axis(block, np.clip(previous, 0, n_steps - 1), axis=0)
+    after = np.take_along_axis(block, np.clip(following, 0, n_steps - 1), axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = (steps - previous) / (following - previous)
+    return np.where(fill, before + weight * (after - before), block)
+
+
+def spatial_mean(block, radius=1, fill_mask=None):
+    '''
+    Fills the NaN values of a block with the mean of the valid values in the square of +-radius
+    pixels around them, at the same time step. Only the values of the block are used.
+
+    block:      data of shape (time, lat, lon) with NaN for the gaps
+    radius:     half width of the square in pixels
+    fill_mask:  optional boolean (lat, lon) array of the pixels that may be filled (e.g. the sea)
+    '''
+    valid = ~np.isnan(block)
+    pad = ((0, 0), (radius + 1, radius), (radius + 1, radius))
+    # Summed area tables of the values and of the valid counts
+    sums = np.pad(np.where(valid, block, 0), pad).cumsum(axis=1).cumsum(axis=2)
+    counts = np.pad(valid.astype(np.float64), pad).cumsum(axis=1).cumsum(axis=2)
+
+    size = 2 * radius + 1
+    lat, lon = block.shape[1:]
+
+    def box(table):
+        return table[:, size:size + lat, size:size + lon] - table[:, :lat, size:size + lon] - \
+            table[:, size:size + lat, :lon] + table[:, :lat, :lon]
+
+    # The counts are exact, the sums of empty windows may not be exactly 0
+    window_counts = box(counts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(window_counts > 0, box(sums) / window_counts, np.nan)
+    fill = ~valid if fill_mask is None else ~valid & fill_mask
+    return np.where(fill, means, block)
+
+
+def fill_block(block, method='window', k=1, spatial=False, radius=1, fill_mask=None):
+    '''
+    Fills the gaps of a block in time (see window_mean and linear_fill), then optionally the
+    remaining gaps in space from the original values of the same day (see spatial_mean)
+    '''
+    if method == 'window':
+        filled = window_mean(block, k)
+    elif method == 'linear':
+        filled = linear_fill(block, k)
+    else:
+        raise ValueError("Unknown gap filling method: " + str(method))
+    if spatial:
+        # The spatial means use the observations only, not the values filled in time
+        filled = np.where(np.isnan(filled), spatial_mean(block, radius, fill_mask), filled)
+    return filled
+
+
+def fill_tile(data, out, rows, cols, fill_mask=None, chunk_size=366, method='window', k=1, spatial=False, radius=1):
+    '''
+    Fills the gaps of a spatial tile of the data, in chunks of time steps. Every chunk is read
+    with a halo of k time steps and radius pixels, so the tiles and the chunks give the same
+    result as the whole cube.
+
+    data:       data of shape (time, lat, lon) with NaN for the gaps
+    out:        array receiving the filled tile
+    rows, cols: slices of the tile
+    '''
+    n_steps, lat, lon = data.shape
+    halo = radius if spatial else 0
+    r1, r2 = max(rows.start - halo, 0), min(rows.stop + halo, lat)
+    c1, c2 = max(cols.start - halo, 0), min(cols.stop + halo, lon)
+    mask = None if fill_mask is None else fill_mask[r1:r2, c1:c2]
+
+    for t1 in range(0, n_steps, chunk_size):
+        t2 = min(t1 + chunk_size, n_steps)
+        h1, h2 = max(t1 - k, 0), min(t2 + k, n_steps)
+        block = np.asarray(data[h1:h2, r1:r2, c1:c2], dtype=np.float64)
+        filled = fill_block(block, method=method, k=k, spatial=spatial, radius=radius, fill_mask=mask)
+        out[t1:t2, rows, cols] = filled[t1 - h1:t2 - h1, rows.start - r1:rows.stop - r1, cols.start - c1:cols.stop - c1]
+
+
+def fill_shared_tile(rows, cols, options):
+    '''
+    Pool task of fill_gaps: fills one tile of the shared data into the shared output
+    '''
+    fill_mask = worker_arrays['fill_mask'][1] if 'fill_mask' in worker_arrays else None
+    fill_tile(worker_arrays['data'][1], worker_arrays['out'][1], rows, cols, fill_mask=fill_mask, **options)
+
+
+def fill_gaps(data, method='window', k=1, spatial=False, radius=1, fill_mask=None, chunk_size=366,
+              tile_shape=(64, 64), n_workers=1):
+    '''
+    Fills the gaps (NaN or masked values) of a (time, lat, lon) cube, e.g. the clouds of the
+    satellite data. The gaps are filled only from the original values, never from filled ones,
+    so the result does not depend on the processing order:
+        window  mean of the valid values of the pixel within +-k days
+        linear  linear interpolation between the previous and next valid values within k days
+    With spatial, the gaps that remain are filled with the mean of the original valid values within
+    +-radius pixels on the same day, only where fill_mask is True (by default the pixels that are
+    valid at least once, so that land stays empty).
+    The cube is processed in chunks of time steps and spatial tiles, in parallel with n_workers > 1.
+    Returns the filled data as an ndarray with NaN for the remaining gaps.
+
+    data:       data of shape (time, lat, lon)
+    method:     'window' or 'linear'
+    k:          size of the time window in days
+    spatial:    spatial fallback for the remaining gaps
+    radius:     half width of the spatial window in pixels
+    fill_mask:  boolean (lat, lon) array of the pixels that may be filled in space
+    chunk_size: number of time steps processed at once
+    tile_shape: (lat, lon) shape of the tiles
+    n_workers:  number of worker processes (None uses all cores)
+    '''
+    data = np.ma.filled(np.ma.asarray(data).astype(np.float64), np.nan)
+    if spatial and fill_mask is None:
+        fill_mask = np.any(~np.isnan(data), axis=0)
+
+    n_steps, lat, lon = data.shape
+    tiles = [(slice(i, min(i + tile_shape[0], lat)), slice(j, min(j + tile_shape[1], lon)))
+             for i, j in itertools.product(range(0, lat, tile_shape[0]), range(0, lon, tile_shape[1]))]
+    options = dict(chunk_size=chunk_size, method=method, k=k, spatial=spatial, radius=radius)
+
+    if n_workers == 1 or len(tiles) == 1:
+        out = np.empty_like(data)
+        for rows, cols in tiles:
+            fill_tile(data, out, rows, cols, fill_mask=fill_mask, **options)
+        return out
+
+    shared = dict()
+    try:
+        shared['data'] = share_array(data)
+        shared['out'] = share_array(np.empty_like(data))
+        if fill_mask is not None:
+            shared['fill_mask'] = share_array(np.asarray(fill_mask, dtype=bool))
+        descriptors = {key: descriptor for key, (_, descriptor) in shared.items()}
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=attach_worker,
+                                 initargs=(descriptors, ('out',))) as pool:
+            for task in [pool.submit(fill_shared_tile, rows, cols, options) for rows, cols in tiles]:
+                task.result()
+        out = np.ndarray(data.shape, dtype=data.dtype, buffer=shared['out'][0].buf).copy()
+    finally:
+        for shm, _ in shared.values():
+            shm.close()
+            shm.unlink()
+
+    return out
@@ -0,0 +1,79 @@
+import os
+import numpy as np
+from global_land_mask import globe
+from reduction import data_key
+from regrid import Regridder, grid_key
+
+
+def cached_mask(path, compute):
+    '''
+    Loads the mask saved at path, or computes it with compute() and saves it
+    '''
+    if path is not None and os.path.exists(path):
+        with np.load(path) as m:
+            return m['mask']
+    mask = compute()
+    if path is not None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez_compressed(path, mask=mask)
+    return mask
+
+
+def land_mask(lons, lats, cache_dir='land_masks'):
+    '''
+    Returns the land mask of a rectilinear grid, shape (lat, lon), True on land and lakes.
+    The mask is computed once per grid and saved in cache_dir, keyed by the grid fingerprint.
+
+    lons:       longitudes of the columns
+    lats:       latitudes of the rows
+    cache_dir:  directory of the saved masks (None disables the cache)
+    '''
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    path = None if cache_dir is None else os.path.join(cache_dir, 'land_' + grid_key(lons, lats) + '.npz')
+
+    def compute():
+        lon_grid, lat_grid = np.meshgrid(lons, lats)
+        return globe.is_land(lat_grid, lon_grid)
+
+    return cached_mask(path, compute)
+
+
+def transfer_mask(mask, lons, lats, new_lons, new_lats, cache_dir='land_masks'):
+    '''
+    Transfers a mask from a rectilinear grid to another one by nearest neighbour (see
+    regrid.Regridder). The result is saved in cache_dir, keyed by both grids and the mask.
+
+    mask:               mask of shape (len(lats), len(lons))
+    lons, lats:         coordinates of the grid of the mask
+    new_lons, new_lats: coordinates of the new grid
+    cache_dir:          directory of the saved masks (None disables the cache)
+    '''
+    mask = np.asarray(mask, dtype=bool)
+    path = None
+    if cache_dir is not None:
+        key = grid_key(new_lons, new_lats, source=grid_key(lons, lats), mask=data_key(mask))
+        path = os.path.join(cache_dir, 'transfer_' + key + '.npz')
+
+    def compute():
+        regridder = Regridder.build(lons, lats, new_lons, new_lats, method='nearest')
+        return regridder(mask.astype(np.float64)) > 0.5
+
+    return cached_mask(path, compute)
+
+
+def apply_mask(data, mask):
+    '''
+    Masks the pixels of every time step of a masked data cube where mask is True, in place,
+    with one broadcast operation
+
+    data:   masked array of shape (time, lat, lon)
+    mask:   boolean mask of shape (lat, lon)
+    '''
+    if np.ma.getmask(data) is np.ma.nomask:
+        data.mask = np.broadcast_to(mask, data.shape)
+    else:
+        # The mask of a slice can be shared with the sliced array
+        data.unshare_mask()
+        np.logical_or(data.mask, mask, out=data.mask)
+    return data
@@ -0,0 +1,96 @@
+import os
+import numpy as np
+import sklearn.cluster as cluster
+from reduction import data_key
+
+
+class MergeTree():
+    '''
+    Full merge tree of an agglomerative clustering. The tree is computed once and the labels
+    for any number of clusters or any distance threshold are obtained by cutting it, without
+    refitting. It has the children_, distances_ and labels_ attributes of sklearn's
+    AgglomerativeClustering, so it can be given to plot_dendrogram.
+
+        tree = MergeTree.fit(data, connectivity=index.adjacency())
+        labels = tree.cut(n_clusters=4)
+    '''
+
+    def __init__(self, children, distances, n_samples):
+        '''
+        children:   merges of the tree, shape (n_samples - 1, 2), as in AgglomerativeClustering.children_
+        distances:  linkage distance of every merge
+        n_samples:  number of leaves
+        '''
+        self.children_ = np.asarray(children, dtype=np.int64)
+        self.distances_ = np.asarray(distances, dtype=np.float64)
+        self.n_samples = n_samples
+        self.n_leaves_ = n_samples
+        self.labels_ = np.zeros(n_samples, dtype=np.int64)
+
+    @classmethod
+    def fit(cls, data, connectivity=None, linkage='ward', cache_dir='merge_trees'):
+        '''
+        Computes the full merge tree of the data, or loads it from cache_dir if it was already
+        computed for the same data, connectivity and linkage.
+
+        data:           matrix of shape (n_samples, n_features)
+        connectivity:   sparse adjacency of the samples (e.g. OceanPixelIndex.adjacency); only
+                        neighbouring clusters are merged, which keeps time and memory sparse
+        linkage:        linkage criterion (ward, complete, average, single)
+        cache_dir:      directory of the cached trees (None disables the cache)
+        '''
+        data = np.asarray(data, dtype=np.float64)
+
+        path = None
+        if cache_dir is not None:
+            if connectivity is None:
+                graph_key = None
+            else:
+                graph = connectivity.tocoo()
+                graph_key = data_key(np.vstack((graph.row, graph.col)))
+            path = os.path.join(cache_dir, data_key(data, connectivity=graph_key, linkage=linkage) + '.npz')
+            if os.path.exists(path):
+                with np.load(path) as tree:
+                    return cls(tree['children'], tree['distances'], len(data))
+
+        model = cluster.AgglomerativeClustering(n_clusters=None, distance_threshold=0, compute_full_tree=True,
+                                                connectivity=connectivity, linkage=linkage)
+        model.fit(data)
+        tree = cls(model.children_, model.distances_, len(data))
+
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(path, children=tree.children_, distances=tree.distances_)
+
+        return tree
+
+    def cut(self, n_clusters=None, distance_threshold=None):
+        '''
+        Returns the labels of the samples when the tree is cut at n_clusters clusters, or at the
+        given distance (merges at a distance >= distance_threshold are not applied).
+        The labels are also stored in labels_.
+
+        n_clusters:         number of clusters
+        distance_threshold: linkage distance at which the tree is cut
+        '''
+        if n_clusters is None:
+            if distance_threshold is None:
+                raise ValueError("Either n_clusters or distance_threshold has to be given")
+            n_clusters = int(np.count_nonzero(self.distances_ >= distance_threshold)) + 1
+        n_clusters = int(min(max(n_clusters, 1), self.n_samples))
+        n_merges = self.n_samples - n_clusters
+
+        # Every node points to the node it is merged into, then the pointers are followed to the roots
+        parent = np.arange(self.n_samples + n_merges)
+        merged = self.children_[:n_merges]
+        parent[merged[:, 0]] = self.n_samples + np.arange(n_merges)
+        parent[merged[:, 1]] = self.n_samples + np.arange(n_merges)
+        while True:
+            grand_parent = parent[parent]
+            if np.array_equal(grand_parent, parent):
+                break
+            parent = grand_parent
+
+        self.labels_ = np.unique(parent[:self.n_samples], return_inverse=True)[1]
+        self.n_clusters_ = n_clusters
+        return self.labels_
@@ -0,0 +1,196 @@
+import os
+import numpy as np
+from cube_store import is_cube
+from running_stats import RunningStats
+
+
+class Normalizer():
+    '''
+    NaN-aware min-max or z-score normalization of data of shape (time, lat, lon[, chemical]),
+    with the statistics of every day, of every pixel or of the whole record (per chemical).
+    The fitted parameters are kept, so the normalized data can be denormalized, and can be saved.
+    The statistics of every chemical are computed in one reduction per chunk of time steps and
+    the data is normalized in place, chunk by chunk:
+
+        normalizer = Normalizer('zscore', 'pixel').fit(matrix)
+        normalizer.transform(chunk, start=t1)
+        normalizer.inverse_transform(chunk, start=t1)
+    '''
+
+    # Modes of save_data.py
+    modes = {'0to1_dayly': ('minmax', 'day'), 'zscore': ('zscore', 'day')}
+
+    def __init__(self, method='minmax', scope='day', offset=None, scale=None):
+        '''
+        method: 'minmax' (scales from 0 to 1) or 'zscore'
+        scope:  'day' (statistics of every time step), 'pixel' (of every pixel through time)
+                or 'global' (of the whole data); always per chemical
+        offset, scale: fitted parameters (see offset and scale), e.g. from a saved normalizer
+        '''
+        if method not in ('minmax', 'zscore'):
+            raise ValueError("Unknown normalization method: " + str(method))
+        if scope not in ('day', 'pixel', 'global'):
+            raise ValueError("Unknown normalization scope: " + str(scope))
+        self.method = method
+        self.scope = scope
+        self._offset = offset
+        self._scale = scale
+        self.stats = RunningStats()
+        self._days = []
+
+    @classmethod
+    def from_mode(cls, mode):
+        '''
+        Returns the normalizer of a mode: '0to1_dayly', 'zscore' (see save_data.py) or
+        'method_scope', e.g. 'zscore_pixel'. Returns None for any other mode (no normalization).
+        '''
+        if mode in cls.modes:
+            return cls(*cls.modes[mode])
+        parts = str(mode).split('_')
+        if len(parts) == 2 and parts[0] in ('minmax', 'zscore') and parts[1] in ('day', 'pixel', 'global'):
+            return cls(*parts)
+        return None
+
+    @property
+    def axis(self):
+        '''
+        Axes of the data reduced by the statistics
+        '''
+        if self.scope == 'day':
+            return (1, 2)
+        if self.scope == 'pixel':
+            return 0
+        return (0, 1, 2)
+
+    def partial_fit(self, chunk):
+        '''
+        Adds a chunk of time steps to the statistics. With the 'day' scope the chunks have to be
+        given in order of time.
+
+        chunk:  data of shape (time, lat, lon[, chemical]); NaN and masked values are ignored
+        '''
+        stats = RunningStats.from_data(chunk, axis=self.axis)
+        if self.scope == 'day':
+            self._days.append(self.parameters(stats))
+        else:
+            self.stats.merge(stats)
+        self._offset = self._scale = None
+        return self
+
+    def fit(self, matrix, chunk_size=366):
+        '''
+        Fits the parameters on the data, read in chunks of time steps
+
+        matrix:     data of shape (time, lat, lon[, chemical]) (ndarray, masked array, memmap or ChunkedCube)
+        chunk_size: number of time steps read at once
+        '''
+        self.stats = RunningStats()
+        self._days = []
+        for t1 in range(0, matrix.shape[0], chunk_size):
+            self.partial_fit(matrix[t1:t1 + chunk_size])
+        return self
+
+    def parameters(self, stats):
+        '''
+        Returns the offset and scale of statistics
+        '''
+        if self.method == 'minmax':
+            return stats.minimum, stats.maximum - stats.minimum
+        return stats.mean, stats.std
+
+    @property
+    def offset(self):
+        '''
+        Value subtracted from the data: the minimum (minmax) or the mean (zscore), of shape
+        (time, [chemical]) for 'day', (lat, lon, [chemical]) for 'pixel' and ([chemical]) for 'global'
+        '''
+        if self._offset is None:
+            self._fitted()
+        return self._offset
+
+    @property
+    def scale(self):
+        '''
+        Value the data is divided by: the range (minmax) or the standard deviation (zscore)
+        '''
+        if self._scale is None:
+            self._fitted()
+        return self._scale
+
+    def _fitted(self):
+        if self.scope == 'day':
+            if len(self._days) == 0:
+                raise ValueError("The normalizer is not fitted")
+            self._offset = np.concatenate([offset for offset, _ in self._days])
+            self._scale = np.concatenate([scale for _, scale in self._days])
+        else:
+            if self.stats.count is None:
+                raise ValueError("The normalizer is not fitted")
+            self._offset, self._scale = self.parameters(self.stats)
+
+    def _broadcast(self, values, start, n_steps):
+        if self.scope == 'day':
+            return np.expand_dims(values[start:start + n_steps], (1, 2))
+        return values
+
+    def transform(self, chunk, start=0):
+        '''
+        Normalizes a chunk of time steps in place and returns it
+
+        chunk:  float data of shape (time, lat, lon[, chemical])
+        start:  time step of the first day of the chunk (for the 'day' scope)
+        '''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            chunk -= self._broadcast(self.offset, start, len(chunk))
+            chunk /= self._broadcast(self.scale, start, len(chunk))
+        return chunk
+
+    def inverse_transform(self, chunk, start=0):
+        '''
+        Denormalizes a chunk of time steps in place and returns it
+
+        chunk:  normalized float data of shape (time, lat, lon[, chemical])
+        start:  time step of the first day of the chunk (for the 'day' scope)
+        '''
+        chunk *= self._broadcast(self.scale, start, len(chunk))
+        chunk += self._broadcast(self.offset, start, len(chunk))
+        return chunk
+
+    def fit_transform(self, matrix, chunk_size=366):
+        '''
+        Fits the parameters and normalizes the data in place, in chunks of time steps.
+        The 'day' scope needs a single pass over the data, the other scopes two.
+
+        matrix:     float data of shape (time, lat, lon[, chemical]) that can be written
+        chunk_size: number of time steps processed at once
+        '''
+        if self.scope == 'day':
+            self._days = []
+            for t1 in range(0, matrix.shape[0], chunk_size):
+                chunk = matrix[t1:t1 + chunk_size]
+                self.partial_fit(chunk)
+                matrix[t1:t1 + chunk_size] = self.transform(chunk, start=t1)
+        else:
+            self.fit(matrix, chunk_size=chunk_size)
+            for t1 in range(0, matrix.shape[0], chunk_size):
+                matrix[t1:t1 + chunk_size] = self.transform(matrix[t1:t1 + chunk_size], start=t1)
+        return matrix
+
+    def save(self, path):
+        np.savez(path, method=self.method, scope=self.scope, offset=self.offset, scale=self.scale)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as n:
+            return cls(str(n['method']), str(n['scope']), offset=n['offset'], scale=n['scale'])
+
+
+def normalization_path(name):
+    '''
+    Path of the normalization parameters saved next to a matrix (inside the cube directory for ChunkedCubes)
+
+    name:   name of the matrix (see cube_store.open_matrix)
+    '''
+    if is_cube(name):
+        return os.path.join(name, 'normalization.npz')
+    return name + '_normalization.npz'
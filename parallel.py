@@ -0,0 +1,48 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+def share_array(array):
+    '''
+    Copies an array into a new shared memory block, so that worker processes can read it
+    without pickling it. Returns the shared memory block (to be closed and unlinked by the
+    caller when done) and the descriptor to give to attach_array.
+
+    array:  array-like to share
+    '''
+    array = np.asarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_array(descriptor, writeable=False):
+    '''
+    Attaches to an array shared with share_array. Returns the shared memory block
+    (to be closed when done) and an array backed by it, read-only unless writeable.
+
+    descriptor: descriptor returned by share_array
+    writeable:  if True the array can be written, e.g. for the results of the workers
+    '''
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    array.flags.writeable = writeable
+    return shm, array
+
+
+# Arrays attached once per worker process (see attach_worker)
+worker_arrays = dict()
+
+
+def attach_worker(descriptors, writeable=()):
+    '''
+    Initializer of pool workers: attaches to the shared arrays once per process.
+    The arrays are then available in worker_arrays under the keys of descriptors.
+
+    descriptors:    dictionary of descriptors returned by share_array
+    writeable:      keys of the arrays the workers write to
+    '''
+    for key, descriptor in descriptors.items():
+        worker_arrays[key] = attach_array(descriptor, writeable=key in writeable)
@@ -0,0 +1,135 @@
+import numpy as np
+from scipy import sparse
+
+
+class OceanPixelIndex():
+    '''
+    Index of the valid (sea) pixels of a grid. It converts gridded data into a contiguous
+    (n_valid, n_features) matrix for clustering and maps label vectors back onto the grid.
+    The pixels are ordered row by row, like np.nonzero(mask).
+
+        index = OceanPixelIndex.from_series(data)
+        features = index.series_to_features(data)
+        labels = index.to_grid(clusterer.labels_)
+    '''
+
+    def __init__(self, mask):
+        '''
+        mask:   boolean array of shape (lat, lon), True for the valid pixels
+        '''
+        self.mask = np.asarray(mask, dtype=bool)
+        self.shape = self.mask.shape
+        self.rows, self.cols = np.nonzero(self.mask)
+        self.n_valid = len(self.rows)
+
+    @classmethod
+    def from_series(cls, data):
+        '''
+        Index of the pixels whose whole time series is valid
+
+        data:   data of shape (time, lat, lon); NaN or masked values are invalid
+        '''
+        valid = ~np.isnan(np.ma.filled(np.ma.asarray(data).astype(np.float64), np.nan))
+        return cls(np.all(valid, axis=0))
+
+    @classmethod
+    def from_frame(cls, data):
+        '''
+        Index of the pixels of a single time step that are valid
+
+        data:   data of shape (lat, lon, chemical) where a pixel is valid if any chemical is not NaN,
+                or data of shape (lat, lon) where a pixel is valid if it is neither masked nor NaN
+        '''
+        if np.ndim(data) == 2:
+            return cls(~np.isnan(np.ma.filled(np.ma.asarray(data).astype(np.float64), np.nan)))
+        if np.ma.isMaskedArray(data):
+            return cls(~np.ma.getmaskarray(data))
+        return cls(np.any(~np.isnan(data), axis=-1))
+
+    def series_to_features(self, data):
+        '''
+        Returns the time series of the valid pixels as a (n_valid, time) matrix
+
+        data:   data of shape (time, lat, lon)
+        '''
+        return np.ascontiguousarray(np.asarray(data)[:, self.mask].T, dtype=np.float64)
+
+    def frame_to_features(self, data):
+        '''
+        Returns the values of the valid pixels of a single time step as a (n_valid, n_features) matrix.
+        2D frames get a second, constant feature so that the matrix is 2D.
+
+        data:   data of shape (lat, lon, chemical) or (lat, lon), masked or not
+        '''
+        if np.ndim(data) == 2:
+            values = np.asarray(np.ma.getdata(data)[self.mask], dtype=np.float64)
+            return np.column_stack((values, np.zeros(self.n_valid)))
+        return np.ascontiguousarray(np.asarray(data)[self.mask].reshape(self.n_valid, -1), dtype=np.float64)
+
+    def to_grid(self, values, fill=np.nan):
+        '''
+        Scatters one value (or one row of values) per valid pixel back onto the grid
+
+        values: array of shape (n_valid, ...)
+        fill:   value of the invalid pixels
+        '''
+        values = np.asarray(values)
+        grid = np.full(self.shape + values.shape[1:], fill,
+                       dtype=np.result_type(values.dtype, np.min_scalar_type(fill)))
+        grid[self.mask] = values
+        return grid
+
+    def adjacency(self, neighbours=4):
+        '''
+        Returns the sparse (n_valid, n_valid) connectivity graph of the valid pixels, where two
+        pixels are connected if they are grid neighbours
+
+        neighbours: 4 (sides) or 8 (sides and diagonals)
+        '''
+        if neighbours == 4:
+            offsets = [(0, 1), (1, 0)]
+        elif neighbours == 8:
+            offsets = [(0, 1), (1, 0), (1, 1), (1, -1)]
+        else:
+            raise ValueError("neighbours has to be 4 or 8")
+
+        position = np.full(self.shape, -1, dtype=np.int64)
+        position[self.mask] = np.arange(self.n_valid)
+
+        rows = []
+        cols = []
+        for di, dj in offsets:
+            # Pixels (i, j) and (i + di, j + dj) that are both inside the grid
+            source = position[max(0, -di):self.shape[0] - max(0, di), max(0, -dj):self.shape[1] - max(0, dj)]
+            target = position[max(0, di):self.shape[0] + min(0, di), max(0, dj):self.shape[1] + min(0, dj)]
+            both = (source >= 0) & (target >= 0)
+            rows.append(source[both])
+            cols.append(target[both])
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+
+        graph = sparse.coo_matrix((np.ones(2 * len(rows)), (np.r_[rows, cols], np.r_[cols, rows])),
+                                  shape=(self.n_valid, self.n_valid))
+        return graph.tocsr()
+
+
+def float_labels(labels):
+    '''
+    Returns the labels as floats where the noise label (-1, see DBSCAN) is NaN
+
+    labels: integer labels of a clustering
+    '''
+    labels = np.asarray(labels)
+    return np.where(labels >= 0, labels, np.nan)
+
+
+def cluster_sizes(labels, n_clusters):
+    '''
+    Returns the number of samples of every cluster as a list; noise labels are ignored
+
+    labels:     integer labels of a clustering
+    n_clusters: number of clusters
+    '''
+    labels = np.asarray(labels)
+    labels = labels[labels >= 0].astype(np.int64)
+    return np.bincount(labels, minlength=n_clusters)[:n_clusters].tolist()
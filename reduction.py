@@ -0,0 +1,156 @@
+import os
+import pickle
+import hashlib
+import numpy as np
+from sklearn.decomposition import IncrementalPCA
+from sklearn.random_projection import GaussianRandomProjection
+
+
+def data_key(data, **params):
+    '''
+    Returns a hash identifying the data and the given parameters
+
+    data:   array-like
+    params: parameters that change the result computed from the data
+    '''
+    data = np.ascontiguousarray(data)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str((data.shape, data.dtype.str, sorted(params.items()))).encode())
+    h.update(data.reshape(-1).view(np.uint8).data if data.size > 0 else b'')
+    return h.hexdigest()
+
+
+def fit_reducer(data, n_components=10, method='pca', batch_size=2048, random_state=0):
+    '''
+    Fits a projector of the samples to n_components dimensions
+
+    data:           matrix of shape (n_samples, n_features)
+    n_components:   number of dimensions after the reduction
+    method:         'pca' incremental PCA fitted in batches of samples,
+                    'random' gaussian random projection
+    batch_size:     number of samples per batch for the incremental PCA
+    random_state:   seed of the random projection
+    '''
+    if method == 'pca':
+        reducer = IncrementalPCA(n_components=n_components)
+        batch_size = max(batch_size, n_components)
+        n_samples = len(data)
+        for i1 in range(0, n_samples, batch_size):
+            i2 = min(i1 + batch_size, n_samples)
+            # The last batch is merged with the previous one if it is too small
+            if n_samples - i2 < n_components:
+                i2 = n_samples
+            reducer.partial_fit(data[i1:i2])
+            if i2 == n_samples:
+                break
+    elif method == 'random':
+        reducer = GaussianRandomProjection(n_components=n_components, random_state=random_state)
+        reducer.fit(data)
+    else:
+        raise ValueError("Unknown reduction method: " + str(method))
+
+    return reducer
+
+
+def fit_block_reducer(blocks, n_components=10, method='pca', batch_size=2048, random_state=0):
+    '''
+    Fits a projector (see fit_reducer) on samples streamed in blocks, e.g. the pixel blocks of
+    clustering.pixel_blocks, without holding all the samples in memory
+
+    blocks:         iterable of matrices of shape (n_block_samples, n_features)
+    n_components:   number of dimensions after the reduction
+    method:         'pca' or 'random' (see fit_reducer)
+    batch_size:     number of samples per batch for the incremental PCA
+    random_state:   seed of the random projection
+    '''
+    if method == 'random':
+        # The random projection only depends on the number of features
+        for features in blocks:
+            # Blocks without valid pixels (e.g. land-only rows) have no sample
+            if len(features) > 0:
+                return fit_reducer(features[:1], n_components=n_components, method=method, random_state=random_state)
+        raise ValueError("No samples to fit the projector")
+    if method != 'pca':
+        raise ValueError("Unknown reduction method: " + str(method))
+
+    reducer = IncrementalPCA(n_components=n_components)
+    batch_size = max(batch_size, n_components)
+    buffer = []
+    n_buffered = 0
+    # The last full batch is held back, so that a too small remainder can be merged with it
+    pending = None
+    for features in blocks:
+        buffer.append(features)
+        n_buffered += len(features)
+        if n_buffered >= batch_size:
+            if pending is not None:
+                reducer.partial_fit(pending)
+            pending = np.concatenate(buffer)
+            buffer = []
+            n_buffered = 0
+    if pending is not None:
+        buffer.insert(0, pending)
+    if len(buffer) == 0 or sum(len(features) for features in buffer) < n_components:
+        raise ValueError("Less samples than n_components to fit the projector")
+    reducer.partial_fit(np.concatenate(buffer))
+
+    return reducer
+
+
+def reducer_path(cache_dir, source, n_components=10, method='pca', batch_size=2048, random_state=0):
+    '''
+    Returns the path of the cached projector fitted on the samples identified by source
+    (e.g. data_key(data)) with the given parameters (see fit_reducer)
+    '''
+    params = dict(n_components=n_components, method=method, random_state=random_state)
+    if method == 'pca':
+        # The incremental PCA depends on the batches
+        params['batch_size'] = batch_size
+    return os.path.join(cache_dir, data_key(np.empty(0), source=source, **params) + '.pkl')
+
+
+def cached_reducer(path, fit):
+    '''
+    Loads the projector saved at path, or fits it with fit() and saves it
+
+    path:   path of the cached projector (see reducer_path), None disables the cache
+    fit:    function returning the fitted projector
+    '''
+    if path is not None and os.path.exists(path):
+        with open(path, 'rb') as fp:
+            return pickle.load(fp)
+    reducer = fit()
+    if path is not None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fp:
+            pickle.dump(reducer, fp)
+    return reducer
+
+
+def reduce_dimensions(data, n_components=10, method='pca', batch_size=2048, random_state=0, cache_dir='reducers'):
+    '''
+    Projects the samples to n_components dimensions and returns the reduced data and the projector.
+    The fitted projector is cached in cache_dir, keyed by the data and the parameters, so that
+    repeated runs on the same data reuse it.
+
+    data:           matrix of shape (n_samples, n_features)
+    n_components:   number of dimensions after the reduction
+    method:         'pca' or 'random' (see fit_reducer)
+    batch_size:     number of samples per batch
+    random_state:   seed of the random projection
+    cache_dir:      directory of the cached projectors (None disables the cache)
+    '''
+    data = np.asarray(data, dtype=np.float64)
+
+    path = None
+    if cache_dir is not None:
+        path = reducer_path(cache_dir, data_key(data), n_components=n_components, method=method,
+                            batch_size=batch_size, random_state=random_state)
+    reducer = cached_reducer(path, lambda: fit_reducer(data, n_components=n_components, method=method,
+                                                       batch_size=batch_size, random_state=random_state))
+
+    reduced = np.empty((len(data), n_components))
+    for i1 in range(0, len(data), batch_size):
+        reduced[i1:i1 + batch_size] = reducer.transform(data[i1:i1 + batch_size])
+
+    return reduced, reducer
@@ -0,0 +1,396 @@
+import numpy as np
+from collections import OrderedDict
+from reduction import data_key
+from result_cache import memoize
+from resampling import resample
+
+
+class RegionIndex():
+    '''
+    Flattened index of a region label map: the pixels of every region are stored contiguously,
+    so that per-region reductions of a whole slab of data are a single np.ufunc.reduceat.
+    The index of a label map is built once and reused (see RegionIndex.of).
+
+        index = RegionIndex.of(region_labels)
+        sums = index.reduce(values)         # values of shape (time, lat, lon, ...)
+    '''
+
+    # Most recently used indexes (at most max_indexes), keyed by the label map
+    _indexes = OrderedDict()
+    max_indexes = 8
+
+    def __init__(self, labels, n_regions=None):
+        '''
+        labels:     region label map of shape (lat, lon); NaN or negative labels are outside every region
+        n_regions:  number of regions (default the largest label + 1)
+        '''
+        labels = np.asarray(labels, dtype=np.float64)
+        self.shape = labels.shape
+        flat = labels.ravel()
+        inside = np.flatnonzero(np.isfinite(flat) & (flat >= 0))
+        region = flat[inside].astype(np.int64)
+
+        order = np.argsort(region, kind='stable')
+        self.pixels = inside[order]
+        self.region = region[order]
+        if n_regions is None:
+            if len(region) == 0:
+                raise ValueError("The label map has no labelled pixel, the number of regions must be given")
+            n_regions = int(region.max()) + 1
+        self.n_regions = n_regions
+        if len(region) > 0 and self.region[-1] >= self.n_regions:
+            raise ValueError("Found label " + str(self.region[-1]) + " for " + str(self.n_regions) + " regions")
+
+        self.sizes = np.bincount(self.region, minlength=self.n_regions)
+        # Regions with pixels and the position of their first pixel
+        self.filled = np.flatnonzero(self.sizes > 0)
+        self.starts = np.r_[0, np.cumsum(self.sizes)[:-1]][self.filled]
+
+    @classmethod
+    def of(cls, labels, n_regions=None):
+        '''
+        Returns the index of a label map, built only the first time it is asked for. Only the
+        max_indexes most recently used indexes are kept.
+
+        labels:     region label map (see RegionIndex)
+        n_regions:  number of regions
+        '''
+        key = data_key(np.asarray(labels, dtype=np.float64), n_regions=n_regions)
+        if key in cls._indexes:
+            cls._indexes.move_to_end(key)
+            return cls._indexes[key]
+        index = cls(labels, n_regions)
+        cls._indexes[key] = index
+        while len(cls._indexes) > cls.max_indexes:
+            cls._indexes.popitem(last=False)
+        return index
+
+    def gather(self, values):
+        '''
+        Returns the values of the pixels of the regions, ordered region by region
+
+        values: array of shape (time, lat, lon, ...)
+        '''
+        values = np.asarray(values)
+        flat = values.reshape(values.shape[:1] + (-1,) + values.shape[3:])
+        return flat[:, self.pixels]
+
+    def reduce(self, values, ufunc=np.add, fill=0):
+        '''
+        Reduces the pixels of every region with ufunc and returns an array of shape
+        (time, n_regions, ...). Regions without pixels get fill.
+
+        values: array of shape (time, lat, lon, ...)
+        ufunc:  reduction (np.add, np.minimum, np.maximum, ...)
+        fill:   value of the empty regions
+        '''
+        gathered = self.gather(values)
+        out = np.full(gathered.shape[:1] + (self.n_regions,) + gathered.shape[2:], fill,
+                      dtype=np.result_type(gathered.dtype, np.min_scalar_type(fill)))
+        if len(self.filled) > 0:
+            out[:, self.filled] = ufunc.reduceat(gathered, self.starts, axis=1)
+        return out
+
+
+@memoize(ignore=('chunk_size', 'progress'), depends=('regions',))
+def region_means(matrix, r_labels, n_regions=None, chunk_size=366, progress=None):
+    '''
+    NaN-aware mean of every region, chemical and time step, computed in one pass over the data.
+    Returns an array of shape (time, n_regions, chemical), or (time, n_regions) for 3D data;
+    regions without valid values are NaN. The results are cached (see result_cache.memoize).
+
+    matrix:     data of shape (time, lat, lon, chemical) or (time, lat, lon); masked values are NaN
+    r_labels:   region labels, different number for different region, NaN outside the regions
+    n_regions:  number of regions (default the largest label + 1)
+    chunk_size: number of time steps read at once
+    progress:   optional callback receiving the fraction of the work done
+    '''
+    index = RegionIndex.of(r_labels, n_regions)
+    n_steps = matrix.shape[0]
+    means = np.full((n_steps, index.n_regions) + tuple(matrix.shape[3:]), np.nan)
+
+    if progress is not None:
+        progress(0)
+
+    for t1 in range(0, n_steps, chunk_size):
+        t2 = min(t1 + chunk_size, n_steps)
+        slab = np.ma.filled(np.ma.asarray(matrix[t1:t2]).astype(np.float64), np.nan)
+
+        valid = ~np.isnan(slab)
+        sums = index.reduce(np.where(valid, slab, 0))
+        counts = index.reduce(valid.astype(np.int64))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[t1:t2] = np.where(counts > 0, sums / counts, np.nan)
+
+        if progress is not None:
+            progress(t2 / n_steps)
+
+    return means
+
+
+def label_at(labels, lons, lats, lon, lat):
+    '''
+    Returns the label of the grid point closest to a location. If that point has no label
+    (land or NaN), the label of the closest labelled point is returned.
+
+    labels:     label map of shape (lat, lon)
+    lons:       longitudes of the columns of the grid
+    lats:       latitudes of the rows of the grid
+    lon, lat:   location, e.g. 8.6865, 54.025 for the estuary of the Elbe, Weser and Rhine rivers
+    '''
+    labels = np.ma.filled(np.ma.asarray(labels).astype(np.float64), np.nan)
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    row = np.argmin(np.abs(lats - lat))
+    col = np.argmin(np.abs(lons - lon))
+    if not np.isnan(labels[row, col]):
+        return labels[row, col]
+
+    rows, cols = np.nonzero(~np.isnan(labels))
+    if len(rows) == 0:
+        raise ValueError("The label map has no labelled point")
+    closest = np.argmin((lats[rows] - lat)**2 + (lons[cols] - lon)**2)
+    return labels[rows[closest], cols[closest]]
+
+
+def region_series(matrix, r_labels, dates, freq='year', region=None, n_regions=None):
+    '''
+    Means of the regions through time, grouped by calendar period: the daily means of every
+    region (see region_means) are averaged over every day, month, season or year, ignoring NaN.
+    Returns the means, shape (n_periods, n_regions, ...) or (n_periods, ...) for a single region,
+    and the first day of every period.
+
+    matrix:     daily data of shape (time, lat, lon, chemical) or (time, lat, lon)
+    r_labels:   region labels, different number for different region, NaN outside the regions
+    dates:      date of every time step
+    freq:       'day', 'month', 'season' or 'year' (see resampling.calendar_edges)
+    region:     if not None, only the means of this region are returned (see label_at)
+    n_regions:  number of regions (default the largest label + 1)
+    '''
+    means = region_means(matrix, r_labels, n_regions=n_regions)
+    return group_by_period(means if region is None else means[:, int(region)], dates, freq=freq)
+
+
+def group_by_period(values, dates, freq='year'):
+    '''
+    Averages values through time over calendar periods, ignoring NaN. Returns the averages and the
+    first day of every period (see resampling.resample); 'day' returns the values as they are.
+
+    values:     array of shape (time, ...)
+    dates:      date of every time step
+    freq:       'day', 'month', 'season' or 'year'
+    '''
+    if freq == 'day':
+        return np.asarray(values), np.asarray(dates, dtype='datetime64[D]')
+    return resample(values, dates, freq=freq)
+
+
+class RegionStatistics():
+    '''
+    Table of statistics of every region through time, indexed by date and region. Every column
+    has shape (time, n_regions, chemical) (or (time, n_regions) for 3D data):
+        count   number of valid pixels
+        mean, std, min, max
+        p10, p50, p90, ... one column per quantile
+
+        stats = region_statistics(matrix, region_labels, dates=dates)
+        stats['p90'][:, 2, 0]                               # P90 of region 2, chemical 0
+        stats.select(date='2010-06-01', region=2)
+        stats.save('region_stats.npz')
+    '''
+
+    def __init__(self, columns, dates=None, quantiles=()):
+        '''
+        columns:    dictionary of the columns (see RegionStatistics)
+        dates:      date of every time step (default the time step indexes)
+        quantiles:  quantiles of the p columns
+        '''
+        self.columns = dict(columns)
+        n_steps = self.columns['count'].shape[0]
+        self.dates = np.arange(n_steps) if dates is None else np.asarray(dates)
+        self.quantiles = tuple(quantiles)
+        self.n_regions = self.columns['count'].shape[1]
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def keys(self):
+        return self.columns.keys()
+
+    def select(self, date=None, region=None):
+        '''
+        Returns the columns at the given date and/or region
+
+        date:   date (or time step index if the table has no dates)
+        region: region label
+        '''
+        key = [slice(None), slice(None)]
+        if date is not None:
+            if np.issubdtype(self.dates.dtype, np.datetime64):
+                date = np.datetime64(date, 'D')
+            step = np.flatnonzero(self.dates == date)
+            if len(step) == 0:
+                raise KeyError(date)
+            key[0] = step[0]
+        if region is not None:
+            key[1] = region
+        return {name: column[tuple(key)] for name, column in self.columns.items()}
+
+    def save(self, path):
+        '''
+        Saves the table in a compressed npz file (counts as int32, statistics as float32)
+        '''
+        columns = {name: column.astype(np.int32 if name == 'count' else np.float32)
+                   for name, column in self.columns.items()}
+        np.savez_compressed(path, dates=self.dates, quantiles=np.asarray(self.quantiles), **columns)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as s:
+            columns = {name: s[name] for name in s.files if name not in ('dates', 'quantiles')}
+            return cls(columns, dates=s['dates'], quantiles=s['quantiles'].tolist())
+
+
+def quantile_name(q):
+    '''
+    Returns the name of the column of a quantile, e.g. 0.1 -> 'p10', 0.025 -> 'p2.5'
+    '''
+    return 'p' + ('%g' % (100 * q))
+
+
+def exact_quantiles(index, slab, quantiles):
+    '''
+    Exact quantiles (linear interpolation, as np.nanquantile) of every region of a slab.
+    Returns an array of shape (n_quantiles, time, n_regions, ...).
+
+    index:      RegionIndex of the label map
+    slab:       data of shape (time, lat, lon, ...) with NaN for the invalid values
+    quantiles:  quantiles in [0, 1]
+    '''
+    gathered = index.gather(slab)
+    out = np.full((len(quantiles),) + gathered.shape[:1] + (index.n_regions,) + gathered.shape[2:], np.nan)
+    for region, start in zip(index.filled, index.starts):
+        # NaN are sorted last, so the valid values of every row come first
+        values = np.sort(gathered[:, start:start + index.sizes[region]], axis=1)
+        n_valid = np.sum(~np.isnan(values), axis=1)
+        for i, q in enumerate(quantiles):
+            position = q * np.maximum(n_valid - 1, 0)
+            below = np.floor(position).astype(np.int64)
+            above = np.minimum(below + 1, np.maximum(n_valid - 1, 0))
+            low = np.take_along_axis(values, below[:, None], axis=1)[:, 0]
+            high = np.take_along_axis(values, above[:, None], axis=1)[:, 0]
+            out[i, :, region] = np.where(n_valid > 0, low + (position - below) * (high - low), np.nan)
+    return out
+
+
+def sketch_quantiles(index, slab, quantiles, minimum, maximum, bins=256):
+    '''
+    Approximate quantiles of every region of a slab from histograms of bins bins spanning the
+    range of every region, time step and chemical. For regions of many pixels the error is about
+    (max - min) / bins; regions of few pixels are better served by exact_quantiles.
+    Returns an array of shape (n_quantiles, time, n_regions, ...).
+
+    index:      RegionIndex of the label map
+    slab:       data of shape (time, lat, lon, ...) with NaN for the invalid values
+    quantiles:  quantiles in [0, 1]
+    minimum:    minimum of every region, shape (time, n_regions, ...)
+    maximum:    maximum of every region, shape (time, n_regions, ...)
+    bins:       number of bins of the histograms
+    '''
+    gathered = index.gather(slab)
+    # Range of the region of every value
+    low = minimum[:, index.region]
+    width = (maximum[:, index.region] - low) / bins
+
+    valid = ~np.isnan(gathered)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        position = np.where(width > 0, (gathered - low) / width, 0)
+    position = np.clip(np.where(valid, position, 0).astype(np.int64), 0, bins - 1)
+
+    # Flat index of the cell (time, region, ...) of every value, then of its bin
+    cells = minimum.shape
+    cell = np.arange(minimum.size).reshape(cells)[:, index.region]
+    histogram = np.bincount((cell * bins + position)[valid], minlength=int(np.prod(cells)) * bins)
+    histogram = histogram.reshape(cells + (bins,))
+
+    cumulative = np.cumsum(histogram, axis=-1)
+    n_valid = cumulative[..., -1]
+    out = np.full((len(quantiles),) + cells, np.nan)
+    for i, q in enumerate(quantiles):
+        # Rank of the quantile among the sorted values, at the middle of its count
+        target = q * np.maximum(n_valid - 1, 0) + 0.5
+        b = np.argmax(cumulative >= target[..., None], axis=-1)
+        in_bin = np.take_along_axis(histogram, b[..., None], axis=-1)[..., 0]
+        before = np.take_along_axis(cumulative, b[..., None], axis=-1)[..., 0] - in_bin
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.where(in_bin > 0, (target - before) / in_bin, 0)
+        value = np.clip(minimum + (b + fraction) * (maximum - minimum) / bins, minimum, maximum)
+        out[i] = np.where(n_valid > 0, value, np.nan)
+    return out
+
+
+@memoize(ignore=('chunk_size', 'progress'), depends=('regions',))
+def region_statistics(matrix, r_labels, n_regions=None, dates=None, quantiles=(0.1, 0.5, 0.9), method='exact',
+                      bins=256, chunk_size=366, progress=None):
+    '''
+    Count, mean, std, min, max and quantiles of every region, chemical and time step, computed in
+    a single pass over the data in slabs of time steps. Returns a RegionStatistics table; the
+    results are cached (see result_cache.memoize).
+
+    matrix:     data of shape (time, lat, lon, chemical) or (time, lat, lon); masked values are NaN
+    r_labels:   region labels, different number for different region, NaN outside the regions
+    n_regions:  number of regions (default the largest label + 1)
+    dates:      date of every time step, the index of the table
+    quantiles:  quantiles in [0, 1]
+    method:     'exact' quantiles (sorting every region) or 'sketch' (histograms, see sketch_quantiles)
+    bins:       for sketch, number of bins of the histograms
+    chunk_size: number of time steps read at once
+    progress:   optional callback receiving the fraction of the work done
+    '''
+    if method not in ('exact', 'sketch'):
+        raise ValueError("Unknown quantile method: " + str(method))
+
+    index = RegionIndex.of(r_labels, n_regions)
+    n_steps = matrix.shape[0]
+    shape = (n_steps, index.n_regions) + tuple(matrix.shape[3:])
+    columns = {name: np.full(shape, np.nan) for name in ['mean', 'std', 'min', 'max']}
+    columns['count'] = np.zeros(shape, dtype=np.int64)
+    values = np.full((len(quantiles),) + shape, np.nan)
+
+    if progress is not None:
+        progress(0)
+
+    for t1 in range(0, n_steps, chunk_size):
+        t2 = min(t1 + chunk_size, n_steps)
+        slab = np.ma.filled(np.ma.asarray(matrix[t1:t2]).astype(np.float64), np.nan)
+
+        valid = ~np.isnan(slab)
+        counts = index.reduce(valid.astype(np.int64))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = index.reduce(np.where(valid, slab, 0)) / counts
+            # Squared deviations from the mean of the region of every pixel
+            deviations = index.gather(slab) - means[:, index.region]
+            squares = np.zeros(means.shape)
+            squares[:, index.filled] = np.add.reduceat(np.where(np.isnan(deviations), 0, deviations ** 2),
+                                                       index.starts, axis=1)
+            std = np.sqrt(squares / counts)
+        minimum = index.reduce(slab, ufunc=np.fmin, fill=np.nan)
+        maximum = index.reduce(slab, ufunc=np.fmax, fill=np.nan)
+
+        columns['count'][t1:t2] = counts
+        columns['mean'][t1:t2] = np.where(counts > 0, means, np.nan)
+        columns['std'][t1:t2] = np.where(counts > 0, std, np.nan)
+        columns['min'][t1:t2] = minimum
+        columns['max'][t1:t2] = maximum
+        if method == 'exact':
+            values[:, t1:t2] = exact_quantiles(index, slab, quantiles)
+        else:
+            values[:, t1:t2] = sketch_quantiles(index, slab, quantiles, minimum, maximum, bins=bins)
+
+        if progress is not None:
+            progress(t2 / n_steps)
+
+    for q, value in zip(quantiles, values):
+        columns[quantile_name(q)] = value
+
+    return RegionStatistics(columns, dates=dates, quantiles=quantiles)
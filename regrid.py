@@ -0,0 +1,201 @@
+import os
+import numpy as np
+from scipy import sparse
+from reduction import data_key
+
+
+def grid_key(lons, lats, **params):
+    '''
+    Returns the fingerprint of a rectilinear grid (and of the given parameters)
+
+    lons:   longitudes of the columns
+    lats:   latitudes of the rows
+    '''
+    return data_key(np.r_[np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64)],
+                    n_lons=len(lons), **params)
+
+
+def nearest_indexes(coordinates, new_coordinates):
+    '''
+    Returns the index of the closest value of coordinates for every value of new_coordinates.
+    The coordinates can be increasing or decreasing.
+    '''
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    new_coordinates = np.asarray(new_coordinates, dtype=np.float64)
+    if len(coordinates) == 1:
+        return np.zeros(len(new_coordinates), dtype=np.int64)
+    order = np.argsort(coordinates)
+    sorted_coordinates = coordinates[order]
+    right = np.clip(np.searchsorted(sorted_coordinates, new_coordinates), 1, len(coordinates) - 1)
+    left = right - 1
+    closest = np.where(np.abs(new_coordinates - sorted_coordinates[left]) <= np.abs(sorted_coordinates[right] - new_coordinates),
+                       left, right)
+    return order[closest]
+
+
+def nearest_weights(coordinates, new_coordinates):
+    '''
+    Sparse (len(new_coordinates), len(coordinates)) operator of the nearest neighbour along one axis
+    '''
+    n_new = len(new_coordinates)
+    return sparse.csr_matrix((np.ones(n_new), (np.arange(n_new), nearest_indexes(coordinates, new_coordinates))),
+                             shape=(n_new, len(coordinates)))
+
+
+def linear_weights(coordinates, new_coordinates):
+    '''
+    Sparse (len(new_coordinates), len(coordinates)) operator of the linear interpolation along one
+    axis. Values outside the coordinates take the closest edge value.
+    '''
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    new_coordinates = np.asarray(new_coordinates, dtype=np.float64)
+    if len(coordinates) == 1:
+        return nearest_weights(coordinates, new_coordinates)
+    order = np.argsort(coordinates)
+    sorted_coordinates = coordinates[order]
+    new_coordinates = np.clip(new_coordinates, sorted_coordinates[0], sorted_coordinates[-1])
+
+    right = np.clip(np.searchsorted(sorted_coordinates, new_coordinates), 1, len(coordinates) - 1)
+    left = right - 1
+    fraction = (new_coordinates - sorted_coordinates[left]) / (sorted_coordinates[right] - sorted_coordinates[left])
+
+    rows = np.arange(len(new_coordinates))
+    return sparse.csr_matrix((np.r_[1 - fraction, fraction], (np.r_[rows, rows], np.r_[order[left], order[right]])),
+                             shape=(len(new_coordinates), len(coordinates)))
+
+
+def cell_edges(coordinates):
+    '''
+    Returns the edges of the cells centred on sorted coordinates, halfway between neighbours
+    '''
+    if len(coordinates) == 1:
+        return np.r_[coordinates[0] - 0.5, coordinates[0] + 0.5]
+    middle = (coordinates[1:] + coordinates[:-1]) / 2
+    return np.r_[2 * coordinates[0] - middle[0], middle, 2 * coordinates[-1] - middle[-1]]
+
+
+def overlap_weights(coordinates, new_coordinates, transform=None):
+    '''
+    Sparse (len(new_coordinates), len(coordinates)) operator of the conservative (overlap weighted)
+    average along one axis: every new cell is the average of the old cells it overlaps, weighted by
+    the overlap.
+
+    transform:  optional function applied to the cell edges before measuring the overlaps,
+                e.g. the sine of the latitude so that the weights are proportional to the areas
+    '''
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    new_coordinates = np.asarray(new_coordinates, dtype=np.float64)
+    order = np.argsort(coordinates)
+    new_order = np.argsort(new_coordinates)
+    edges = cell_edges(coordinates[order])
+    new_edges = cell_edges(new_coordinates[new_order])
+    if transform is not None:
+        edges = transform(edges)
+        new_edges = transform(new_edges)
+
+    rows = []
+    cols = []
+    weights = []
+    # First and last old cell overlapping every new cell
+    first = np.clip(np.searchsorted(edges, new_edges[:-1], side='right') - 1, 0, len(coordinates) - 1)
+    last = np.clip(np.searchsorted(edges, new_edges[1:], side='left') - 1, 0, len(coordinates) - 1)
+    for i in range(len(new_coordinates)):
+        cells = np.arange(first[i], last[i] + 1)
+        overlap = np.minimum(edges[cells + 1], new_edges[i + 1]) - np.maximum(edges[cells], new_edges[i])
+        keep = overlap > 0
+        rows.append(np.full(np.sum(keep), new_order[i]))
+        cols.append(order[cells[keep]])
+        weights.append(overlap[keep])
+
+    return sparse.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(len(new_coordinates), len(coordinates)))
+
+
+class Regridder():
+    '''
+    Sparse interpolation operator from a rectilinear grid to another one. The operator is built
+    once per pair of grids and method, saved in cache_dir, and applied to labels, masks or whole
+    (time, lat, lon) cubes as one sparse matrix product per chunk of time steps.
+
+        regridder = Regridder.build(sat_lons, sat_lats, model_lons, model_lats, method='conservative')
+        sat_on_model = regridder(sat_data)
+    '''
+
+    def __init__(self, operator, shape, new_shape):
+        '''
+        operator:   sparse (n_new_pixels, n_pixels) matrix of the weights
+        shape:      (lat, lon) shape of the source grid
+        new_shape:  (lat, lon) shape of the target grid
+        '''
+        self.operator = operator.tocsr()
+        self.shape = tuple(shape)
+        self.new_shape = tuple(new_shape)
+
+    @classmethod
+    def build(cls, lons, lats, new_lons, new_lats, method='nearest', cache_dir='regridders'):
+        '''
+        Builds the operator from the grid (lons, lats) to the grid (new_lons, new_lats), or loads it
+        from cache_dir
+
+        lons, lats:         coordinates of the columns and rows of the source grid
+        new_lons, new_lats: coordinates of the columns and rows of the target grid
+        method:             'nearest', 'bilinear' or 'conservative' (area weighted average of the
+                            source cells overlapping every target cell, for downscaling)
+        cache_dir:          directory of the saved operators (None disables the cache)
+        '''
+        shape = (len(lats), len(lons))
+        new_shape = (len(new_lats), len(new_lons))
+
+        path = None
+        if cache_dir is not None:
+            key = grid_key(new_lons, new_lats, source=grid_key(lons, lats), method=method)
+            path = os.path.join(cache_dir, key + '.npz')
+            if os.path.exists(path):
+                return cls(sparse.load_npz(path), shape, new_shape)
+
+        if method == 'nearest':
+            row_weights = nearest_weights(lats, new_lats)
+            col_weights = nearest_weights(lons, new_lons)
+        elif method == 'bilinear':
+            row_weights = linear_weights(lats, new_lats)
+            col_weights = linear_weights(lons, new_lons)
+        elif method == 'conservative':
+            row_weights = overlap_weights(lats, new_lats, transform=lambda edges: np.sin(np.radians(np.clip(edges, -90, 90))))
+            col_weights = overlap_weights(lons, new_lons)
+        else:
+            raise ValueError("Unknown regridding method: " + str(method))
+
+        # Pixels are ordered row by row, so the 2D operator is the product of the 1D ones
+        operator = sparse.kron(row_weights, col_weights, format='csr')
+
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            sparse.save_npz(path, operator)
+
+        return cls(operator, shape, new_shape)
+
+    def __call__(self, values, chunk_size=366):
+        '''
+        Regrids a field of shape (lat, lon) or a cube of shape (time, lat, lon). NaN and masked
+        values are ignored (the weights of the valid values are renormalized); target pixels
+        without valid values are NaN, or masked if values is a masked array.
+
+        values:     field or cube on the source grid
+        chunk_size: number of time steps regridded at once
+        '''
+        single = np.ndim(values) == 2
+        masked = np.ma.isMaskedArray(values)
+        cube = values[None] if single else values
+        out = np.empty((cube.shape[0],) + self.new_shape)
+
+        for t1 in range(0, cube.shape[0], chunk_size):
+            t2 = min(t1 + chunk_size, cube.shape[0])
+            chunk = np.ma.filled(np.ma.asarray(cube[t1:t2]).astype(np.float64), np.nan).reshape(t2 - t1, -1)
+            valid = ~np.isnan(chunk)
+            sums = self.operator @ np.where(valid, chunk, 0).T
+            weights = self.operator @ valid.T.astype(np.float64)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                out[t1:t2] = np.where(weights > 0, sums / weights, np.nan).T.reshape((t2 - t1,) + self.new_shape)
+
+        out = out[0] if single else out
+        return np.ma.masked_invalid(out) if masked else out
@@ -0,0 +1,127 @@
+import sys
+import pickle
+import numpy as np
+
+
+def progress_bar(width=10):
+    '''
+    Returns a progress callback that draws a bar of the given width on stdout.
+    The callback takes the fraction of the work done (0 to 1).
+
+    width:  number of characters of the bar
+    '''
+    state = dict(drawn=0)
+
+    def callback(fraction):
+        if state['drawn'] == 0 and fraction == 0:
+            sys.stdout.write("[%s]" % (" " * width))
+            sys.stdout.write("\b" * (width + 1))
+        n = int(fraction * width)
+        if n > state['drawn']:
+            sys.stdout.write(chr(9608) * (n - state['drawn']))
+            state['drawn'] = n
+        if fraction >= 1:
+            sys.stdout.write("\n")
+        sys.stdout.flush()
+
+    return callback
+
+
+def binned_nanmean(matrix, edges, chunk_size=366, progress=None):
+    '''
+    NaN-aware mean of the data over consecutive time bins. Bin i covers the time steps
+    edges[i] to edges[i+1] (excluded); bins without valid values are NaN.
+    The data is read in slabs of chunk_size time steps, so matrix can be any array-like
+    that supports slicing along the first axis (ndarray, masked array, memmap, ChunkedCube).
+
+    matrix:     data of shape (time, ...); masked values are treated as NaN
+    edges:      increasing time indexes delimiting the bins, shape (n_bins + 1,)
+    chunk_size: number of time steps read at once
+    progress:   optional callback receiving the fraction of the work done
+    '''
+    edges = np.asarray(edges, dtype=np.int64)
+    n_bins = len(edges) - 1
+    sums = np.zeros((n_bins,) + tuple(matrix.shape[1:]))
+    counts = np.zeros((n_bins,) + tuple(matrix.shape[1:]), dtype=np.int64)
+
+    t_start = int(edges[0])
+    t_end = int(edges[-1])
+    if progress is not None:
+        progress(0)
+
+    for t1 in range(t_start, t_end, chunk_size):
+        t2 = min(t1 + chunk_size, t_end)
+        slab = np.ma.filled(np.ma.asarray(matrix[t1:t2]).astype(np.float64), np.nan)
+
+        # Bin of every time step of the slab and first time step of every bin in the slab
+        bins = np.searchsorted(edges, np.arange(t1, t2), side='right') - 1
+        starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+
+        valid = ~np.isnan(slab)
+        sums[bins[starts]] += np.add.reduceat(np.where(valid, slab, 0), starts, axis=0)
+        counts[bins[starts]] += np.add.reduceat(valid, starts, axis=0, dtype=np.int64)
+
+        if progress is not None:
+            progress((t2 - t_start) / max(t_end - t_start, 1))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def load_dates(path='datetimes.txt'):
+    '''
+    Loads the dates saved by save_data.py as a compact datetime64[D] index
+
+    path:   path of the pickled list of dates
+    '''
+    with open(path, "rb") as fp:
+        d = pickle.load(fp)
+    return np.asarray(d, dtype='datetime64[D]')
+
+
+def calendar_edges(dates, freq='month'):
+    '''
+    Groups a sorted date index into calendar periods. Returns the bin edges (time indexes,
+    see binned_nanmean) and the first day of every period as datetime64[D].
+
+    dates:  sorted dates (list of datetime.date or datetime64 array)
+    freq:   'month', 'season' (meteorological seasons DJF, MAM, JJA, SON; December belongs
+            to the winter of the following year) or 'year'
+    '''
+    months = np.asarray(dates, dtype='datetime64[D]').astype('datetime64[M]').astype(np.int64)
+
+    if freq == 'month':
+        keys = months
+        starts = keys
+    elif freq == 'season':
+        keys = (months + 1) // 3
+        starts = keys * 3 - 1
+    elif freq == 'year':
+        keys = months // 12
+        starts = keys * 12
+    else:
+        raise ValueError("Unknown frequency: " + str(freq))
+
+    first = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    edges = np.r_[first, len(keys)]
+    bin_dates = starts[first].astype('datetime64[M]').astype('datetime64[D]')
+
+    return edges, bin_dates
+
+
+def resample(matrix, dates, freq='month', chunk_size=366, progress=None):
+    '''
+    Averages the data over true calendar periods in one pass.
+    Returns the averaged data and the first day of every period.
+
+    matrix:     data of shape (time, ...), see binned_nanmean
+    dates:      sorted dates of the time steps of matrix
+    freq:       'month', 'season' or 'year' (see calendar_edges)
+    chunk_size: number of time steps read at once
+    progress:   optional callback receiving the fraction of the work done
+    '''
+    if len(dates) != matrix.shape[0]:
+        raise ValueError("Got " + str(len(dates)) + " dates for " + str(matrix.shape[0]) + " time steps")
+
+    edges, bin_dates = calendar_edges(dates, freq=freq)
+    return binned_nanmean(matrix, edges, chunk_size=chunk_size, progress=progress), bin_dates
@@ -0,0 +1,241 @@
+import os
+import pickle
+import importlib
+import inspect
+import hashlib
+import functools
+import numpy as np
+from scipy import sparse
+try:
+    from numpy.lib.array_utils import byte_bounds
+except ImportError:
+    byte_bounds = np.byte_bounds
+from reduction import data_key
+from cube_store import ChunkedCube
+
+
+class ResultStore():
+    '''
+    On-disk store of pickled results, keyed by a hash (see memoize). When the files of the store
+    take more than max_bytes, the least recently used results are removed.
+
+        store = ResultStore('result_cache', max_bytes=2 * 1024**3)
+        store.put(key, value)
+        value = store.get(key)
+    '''
+
+    def __init__(self, directory='result_cache', max_bytes=2 * 1024**3):
+        '''
+        directory:  directory of the results
+        max_bytes:  maximal size of the store
+        '''
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        '''
+        Returns the result stored under key, or raises KeyError
+        '''
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as fp:
+                value = pickle.load(fp)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            raise KeyError(key)
+        # The modification time records the last use
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key, value):
+        '''
+        Stores a result under key and evicts the least recently used results if needed
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        # Written to a temporary file first, so that concurrent readers never see a partial result
+        temporary = path + '.' + str(os.getpid()) + '.tmp'
+        with open(temporary, 'wb') as fp:
+            pickle.dump(value, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        '''
+        Removes the least recently used results until the store is smaller than max_bytes
+
+        keep:   key that is never removed (the result just stored)
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pkl'):
+                continue
+            try:
+                info = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((info.st_mtime, info.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == str(keep) + '.pkl':
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        '''
+        Removes every result of the store
+        '''
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(self.directory, name))
+
+
+# Store used by memoize when none is given
+default_store = ResultStore()
+
+
+def file_fingerprint(path):
+    '''
+    Returns a tuple identifying the current content of a file or directory from the names, sizes
+    and modification times of its files, without reading them. Missing files give None.
+
+    path:   file or directory
+    '''
+    if os.path.isfile(path):
+        info = os.stat(path)
+        return (os.path.abspath(path), info.st_size, info.st_mtime_ns)
+    if os.path.isdir(path):
+        files = []
+        for root, _, names in os.walk(path):
+            for name in names:
+                info = os.stat(os.path.join(root, name))
+                files.append((os.path.relpath(os.path.join(root, name), path), info.st_size, info.st_mtime_ns))
+        return (os.path.abspath(path), tuple(sorted(files)))
+    return None
+
+
+def fingerprint(value):
+    '''
+    Returns a string identifying an argument of a memoized function: arrays are hashed, memory-mapped
+    arrays (and their slices) and cubes are identified by their files (see file_fingerprint) and
+    position in them, containers recursively and other values by their repr.
+
+    value:  argument
+    '''
+    if isinstance(value, ChunkedCube):
+        return 'cube' + str(file_fingerprint(value.path))
+    if isinstance(value, np.memmap) and getattr(value, 'filename', None) is not None:
+        # Slices keep the filename and offset of the whole map, so their position in the map and
+        # their strides identify them
+        mapped = value
+        while isinstance(mapped.base, np.ndarray):
+            mapped = mapped.base
+        start = byte_bounds(value)[0] - byte_bounds(mapped)[0]
+        return 'memmap' + str((file_fingerprint(value.filename), value.offset, start, value.shape,
+                               value.strides, value.dtype.str))
+    if sparse.issparse(value):
+        graph = value.tocoo()
+        return 'sparse' + data_key(np.vstack((graph.row, graph.col)), data=data_key(graph.data), shape=graph.shape)
+    if isinstance(value, np.ndarray):
+        if np.ma.isMaskedArray(value):
+            return 'masked' + data_key(np.ma.getdata(value), mask=data_key(np.ma.getmaskarray(value)))
+        return 'array' + data_key(value)
+    if isinstance(value, (list, tuple)):
+        return type(value).__name__ + '(' + ','.join(fingerprint(v) for v in value) + ')'
+    if isinstance(value, dict):
+        return 'dict(' + ','.join(repr(k) + ':' + fingerprint(value[k]) for k in sorted(value, key=repr)) + ')'
+    return repr(value)
+
+
+def source_code(dependency):
+    '''
+    Returns the source code of a function, class or module, or of a module given by its name
+    '''
+    if isinstance(dependency, str):
+        dependency = importlib.import_module(dependency)
+    try:
+        return inspect.getsource(dependency)
+    except (OSError, TypeError):
+        return getattr(dependency, '__qualname__', getattr(dependency, '__name__', repr(dependency)))
+
+
+def memoize(function=None, ignore=(), sources=(), files=(), depends=(), store=None):
+    '''
+    Decorator caching the results of a function in a ResultStore. The key is a hash of the source
+    code of the function and of the code it calls (depends), of all its arguments (defaults
+    included, see fingerprint) and of the files in sources, so a result is recomputed whenever
+    any of them changes.
+
+        @memoize(ignore=('verbose',), sources=('model_data',), depends=('resampling',))
+        def f(matrix, n, verbose=True): ...
+
+    The original function is available as f.__wrapped__.
+
+    ignore:     names of the arguments that do not change the result (verbosity, progress, workers)
+    sources:    files or directories read by the function (see file_fingerprint)
+    files:      names of the arguments that are paths of files read by the function; the files
+                are fingerprinted instead of the paths
+    depends:    functions, classes or modules (or module names) called by the function, whose
+                code changes the result. Modules given by name are read at the first call, so a
+                module can depend on itself.
+    store:      ResultStore of the results (default_store if None)
+    '''
+    if function is None:
+        return lambda f: memoize(f, ignore=ignore, sources=sources, files=files, depends=depends, store=store)
+
+    signature = inspect.signature(function)
+    code = source_code(function)
+    # Code of the dependencies, read at the first call
+    dependencies = []
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = {}
+        for name, value in bound.arguments.items():
+            if signature.parameters[name].kind == inspect.Parameter.VAR_KEYWORD:
+                arguments.update({key: v for key, v in value.items() if key not in ignore})
+            elif name in files:
+                arguments[name] = file_fingerprint(value)
+            elif name not in ignore:
+                arguments[name] = value
+
+        h = hashlib.blake2b(digest_size=16)
+        h.update((function.__module__ + '.' + function.__qualname__).encode())
+        if len(dependencies) < len(depends):
+            dependencies[:] = [source_code(dependency) for dependency in depends]
+        h.update(code.encode())
+        for dependency in dependencies:
+            h.update(dependency.encode())
+        h.update(fingerprint(arguments).encode())
+        h.update(str([file_fingerprint(path) for path in sources]).encode())
+        key = h.hexdigest()
+
+        results = default_store if store is None else store
+        try:
+            return results.get(key)
+        except KeyError:
+            pass
+
+        result = function(*args, **kwargs)
+        results.put(key, result)
+        return result
+
+    return wrapper
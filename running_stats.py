@@ -0,0 +1,161 @@
+import os
+import numpy as np
+from cube_store import is_cube, open_matrix
+
+
+class RunningStats():
+    '''
+    Single-pass NaN-aware statistics (count, mean, variance, min, max) of data streamed
+    in chunks. Means and variances are accumulated with Welford/Chan updates, so the
+    statistics of different chunks or workers can be merged without loss of precision.
+
+        stats = RunningStats()
+        for chunk in chunks:
+            stats.update(chunk)
+        stats.mean, stats.std, stats.minimum, stats.maximum
+    '''
+
+    def __init__(self, count=None, mean=None, m2=None, minimum=None, maximum=None):
+        self.count = count
+        self._mean = mean
+        self.m2 = m2
+        self._minimum = minimum
+        self._maximum = maximum
+
+    @classmethod
+    def from_data(cls, data, axis=0):
+        '''
+        Statistics of the data reduced over the given axis (or axes); NaN and masked
+        values are ignored
+
+        data:   array-like or masked array
+        axis:   axis or tuple of axes reduced
+        '''
+        data = np.ma.filled(np.ma.asarray(data).astype(np.float64), np.nan)
+        valid = ~np.isnan(data)
+
+        count = np.sum(valid, axis=axis)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, np.sum(np.where(valid, data, 0), axis=axis) / count, 0)
+        deviation = np.where(valid, data - np.expand_dims(mean, axis), 0)
+        m2 = np.sum(deviation * deviation, axis=axis)
+        minimum = np.min(np.where(valid, data, np.inf), axis=axis)
+        maximum = np.max(np.where(valid, data, -np.inf), axis=axis)
+
+        return cls(count, mean, m2, minimum, maximum)
+
+    def update(self, chunk):
+        '''
+        Adds a chunk of time steps (first axis) to the statistics
+
+        chunk:  data of shape (time, ...)
+        '''
+        return self.merge(RunningStats.from_data(chunk, axis=0))
+
+    def merge(self, other):
+        '''
+        Merges the statistics of another chunk or worker into this one and returns it
+
+        other:  RunningStats with the same shape
+        '''
+        if other.count is None:
+            return self
+        if self.count is None:
+            self.count, self._mean, self.m2 = other.count.copy(), other._mean.copy(), other.m2.copy()
+            self._minimum, self._maximum = other._minimum.copy(), other._maximum.copy()
+            return self
+
+        count = self.count + other.count
+        delta = other._mean - self._mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(count > 0, other.count / count, 0)
+        self._mean = self._mean + delta * weight
+        self.m2 = self.m2 + other.m2 + delta * delta * self.count * weight
+        self.count = count
+        self._minimum = np.minimum(self._minimum, other._minimum)
+        self._maximum = np.maximum(self._maximum, other._maximum)
+        return self
+
+    @property
+    def mean(self):
+        return np.where(self.count > 0, self._mean, np.nan)
+
+    @property
+    def variance(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.m2 / self.count, np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def minimum(self):
+        return np.where(self.count > 0, self._minimum, np.nan)
+
+    @property
+    def maximum(self):
+        return np.where(self.count > 0, self._maximum, np.nan)
+
+    def save(self, path):
+        np.savez(path, count=self.count, mean=self._mean, m2=self.m2,
+                 minimum=self._minimum, maximum=self._maximum)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as s:
+            return cls(s['count'], s['mean'], s['m2'], s['minimum'], s['maximum'])
+
+
+def compute_stats(matrix, start=None, stop=None, chunk_size=366):
+    '''
+    Streams the time steps start to stop (excluded) of the matrix in chunks and returns their
+    per-pixel RunningStats
+
+    matrix:     data of shape (time, ...) (ndarray, masked array, memmap or ChunkedCube)
+    start:      first time step of the window (default 0)
+    stop:       end of the window (default the whole record)
+    chunk_size: number of time steps read at once
+    '''
+    start = 0 if start is None else start
+    stop = matrix.shape[0] if stop is None else min(stop, matrix.shape[0])
+
+    stats = RunningStats()
+    for t1 in range(start, stop, chunk_size):
+        stats.update(matrix[t1:min(t1 + chunk_size, stop)])
+    return stats
+
+
+def stats_path(name, start=None, stop=None):
+    '''
+    Path of the statistics saved next to a matrix (inside the cube directory for ChunkedCubes)
+
+    name:   name of the matrix (see cube_store.open_matrix)
+    start:  first time step of the window
+    stop:   end of the window
+    '''
+    suffix = '' if start is None and stop is None else '_' + str(start) + '_' + str(stop)
+    if is_cube(name):
+        return os.path.join(name, 'stats' + suffix + '.npz')
+    return name + '_stats' + suffix + '.npz'
+
+
+def cached_stats(name, matrix=None, start=None, stop=None, chunk_size=366):
+    '''
+    Returns the statistics saved next to a matrix, computing and saving them if needed
+
+    name:       name of the matrix (see cube_store.open_matrix)
+    matrix:     the opened matrix; opened from name if None
+    start:      first time step of the window
+    stop:       end of the window
+    chunk_size: number of time steps read at once
+    '''
+    path = stats_path(name, start, stop)
+    if os.path.exists(path):
+        return RunningStats.load(path)
+
+    if matrix is None:
+        matrix = open_matrix(name)
+    stats = compute_stats(matrix, start=start, stop=stop, chunk_size=chunk_size)
+    stats.save(path)
+    return stats
@@ -9,14 +9,22 @@ import cartopy.feature as cfeature
 from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
 from visualization import TimeSeries, SateliteTimeSeries, geographic_plot
 from clustering import sort_clusters, clustering, timestep_clustering, average_data, single_chemical_clustering
-from global_land_mask import globe
-from scipy.interpolate import griddata
+from double_clustering import region_calculation, compute_regions
+from regions import region_means, region_series, label_at
+from result_cache import memoize
+from landmask import land_mask, transfer_mask, apply_mask
+from regrid import Regridder
+from gapfill import fill_gaps
+from normalization import Normalizer
 
 
-def readSatData(path):
+def readSatData(path, bounds=None):
     '''
         Reads in NetCDF4 files from the given path and returns them as a numpy matrix.
         Outputs the longitude and latitude matrices.
+
+        bounds: optional (minLon, maxLon, minLat, maxLat) window, see gridWindow. Only the window
+                is read from the file.
     '''
     dataset = Dataset(path, mode='r')
     key = list(dataset.variables)[0]
@@ -37,7 +45,13 @@ def readSatData(path):
         lons = dataset.variables['longitude'][:]
         lats = dataset.variables['latitude'][:]
 
-    data = np.squeeze(dataset.variables[key][:])
+    if bounds is None:
+        data = np.squeeze(dataset.variables[key][:])
+    else:
+        rows, cols = gridWindow(lons, lats, bounds)
+        lons = lons[cols]
+        lats = lats[rows]
+        data = np.squeeze(dataset.variables[key][..., rows, cols])
 
     unit = dataset.variables[key].units
 
@@ -53,6 +67,49 @@ def readSatData(path):
     return data, lons, lats, d, key, unit
 
 
+def gridBounds(lons, lats):
+    '''
+    Returns the (minLon, maxLon, minLat, maxLat) bounding box of a grid
+    '''
+    return (np.min(lons), np.max(lons), np.min(lats), np.max(lats))
+
+
+def gridWindow(lons, lats, bounds):
+    '''
+    Returns the slices of the rows (lats) and columns (lons) of a grid covering the bounding box,
+    with one more grid line on every side so that the box is fully covered. The coordinates can be
+    increasing or decreasing.
+
+    lons:   longitudes of the columns
+    lats:   latitudes of the rows
+    bounds: (minLon, maxLon, minLat, maxLat), see gridBounds
+    '''
+    minLon, maxLon, minLat, maxLat = bounds
+
+    def window(values, low, high):
+        inside = np.flatnonzero((values >= low) & (values <= high))
+        if len(inside) == 0:
+            return slice(0, 0)
+        return slice(max(inside[0] - 1, 0), min(inside[-1] + 2, len(values)))
+
+    return window(np.asarray(lats), minLat, maxLat), window(np.asarray(lons), minLon, maxLon)
+
+
+@memoize(files=('path',), depends=(readSatData, 'regions'))
+def read_region_means(path, labels, n_regions=None):
+    '''
+    Daily means of every cluster of labels for the quantity of a NetCDF file, shape (time, n_regions)
+    (see regions.region_means). The results are cached until the file or the labels change, so the
+    file is only read the first time.
+
+    path:       path of the NetCDF file
+    labels:     labels of the clustering algorithm, on the grid of the file
+    n_regions:  number of clusters (default the largest label + 1)
+    '''
+    data = readSatData(path)[0]
+    return region_means.__wrapped__(data, labels, n_regions=n_regions)
+
+
 def findClose(vector, reference, end='min', reverse = False):
     '''
     Search for the index at which vector has a similar value to 'reference'. When the 'min' is given, the closest
@@ -90,39 +147,55 @@ def findClose(vector, reference, end='min', reverse = False):
 
 
 def removeTimeSteps(data, rmIdx, dates):
-    # Remove the data of unmatched time steps from the satelite data
-    data1 = np.ma.copy(data)
-    dates1 = dates.copy()
-    for idxToRemove in reversed(rmIdx):
-        dates1.pop(idxToRemove)
-        data1 = data1[np.arange(len(data1[:, 0, 0])) != idxToRemove]
+    '''
+    Removes the time steps rmIdx from the data and the dates with a single gather
+    '''
+    keep = np.ones(len(dates), dtype=bool)
+    keep[np.asarray(rmIdx, dtype=np.int64)] = False
+    return takeTimeSteps(data, np.flatnonzero(keep), dates)
+
+
+def takeTimeSteps(data, idx, dates):
+    '''
+    Keeps the time steps idx (sorted) of the data and the dates. The data is gathered at once, and
+    not copied at all when every time step is kept.
+    '''
+    idx = np.asarray(idx, dtype=np.int64)
+    if len(idx) == len(dates) and np.array_equal(idx, np.arange(len(dates))):
+        return data, list(dates)
+    return data[idx], [dates[i] for i in idx]
 
-    return data1, dates1
+
+def matchTimeSteps(dates1, dates2):
+    '''
+    Returns the indexes of the dates that are in both date lists, in dates1 and in dates2 (sorted join)
+    '''
+    days1 = np.asarray(dates1, dtype='datetime64[D]')
+    days2 = np.asarray(dates2, dtype='datetime64[D]')
+    _, idx1, idx2 = np.intersect1d(days1, days2, return_indices=True)
+    return idx1, idx2
 
 
 class DataSet():
 
-    def __init__(self, filename):
+    def __init__(self, filename, bounds=None):
         [self.data, self.lons, self.lats, self.times, self.keys,
-            self.unit] = readSatData(os.path.abspath(filename))
+            self.unit] = readSatData(os.path.abspath(filename), bounds=bounds)
 
 
 class SateliteData(DataSet):
     def __init__(self, filename):
-        super().__init__(filename)
+        dataset = Dataset(os.path.abspath(filename), mode='r')
+        n_times = len(dataset.variables['time'])
+        dataset.close()
 
-        if len(self.times) != 252:
+        if n_times != 252:
+            # Only the part of the satellite data over the model domain is read
             self.RefSet = DataSet('MetO-NWS-BIO-dm-CHL.nc')
+            super().__init__(filename, bounds=gridBounds(self.RefSet.lons, self.RefSet.lats))
 
-            try:
-                with np.load('region_labels.npz') as r_labels:
-                    region_labels = r_labels['matrix']
-            except:
-                region_labels = region_calculation(
-                    n_regions=4, show_silhouette=True)
-                np.savez_compressed('region_labels.npz', matrix=region_labels)
-
-            self.regionLabels = region_labels
+            # Cached, see double_clustering.compute_regions
+            self.regionLabels = compute_regions(n_regions=4)[0]
 
             self.removeUnmatchingTime()
 
@@ -131,115 +204,89 @@ class SateliteData(DataSet):
             self.reduceSizeSpace()
 
             self.removeLandPixels()
+        else:
+            super().__init__(filename)
 
     def removeUnmatchingTime(self):
 
         print("\nRemoving non overlapping days from lists...")
-        removeSat = list()
-        removeNormal = list()
 
-        # Look for dates that have to be removed from the satelite data
-        for counter, elem in enumerate(self.times):
-            if elem not in self.RefSet.times:
-                removeSat.append(counter)
-
-        # Look for dates that have to be removed from the normal data
-        for counter, elem in enumerate(self.RefSet.times):
-            if elem not in self.times:
-                removeNormal.append(counter)
+        # Time steps of the dates present in both data sets
+        keepSat, keepNormal = matchTimeSteps(self.times, self.RefSet.times)
+        nRemovedSat = len(self.times) - len(keepSat)
+        nRemovedNormal = len(self.RefSet.times) - len(keepNormal)
 
         # Remove the data of unmatched time steps from the satelite data
-        [self.data, self.times] = removeTimeSteps(
-            self.data, removeSat, self.times)
+        [self.data, self.times] = takeTimeSteps(self.data, keepSat, self.times)
 
         # Remove the data of unmatched time steps from the normal data
-        [self.RefSet.data, self.RefSet.times] = removeTimeSteps(
-            self.RefSet.data, removeNormal, self.RefSet.times)
+        [self.RefSet.data, self.RefSet.times] = takeTimeSteps(
+            self.RefSet.data, keepNormal, self.RefSet.times)
 
         if self.times == self.RefSet.times and len(self.RefSet.data) == len(self.data):
-            print("Successfully removed "+str(len(removeSat)) +
+            print("Successfully removed "+str(nRemovedSat) +
                   " elements from the satelite data.")
-            print("Successfully removed "+str(len(removeNormal)) +
+            print("Successfully removed "+str(nRemovedNormal) +
                   " elements from the normal data.\n")
         else:
             print("ERROR")
 
     def removeEmptyLines(self):
-        alwaysFilled = np.ones((self.data[0].shape), dtype=bool)
-        alwaysMasked = np.ones((self.data[0].shape), dtype=bool)
-
-        rmCol = list()
-        rmRow = list()
-
-        for frame in self.data[:]:
-            alwaysFilled = alwaysFilled & ~frame.mask
-            alwaysMasked = alwaysMasked & frame.mask
-
-        for i in range(len(self.data[0, :, 0])):
-            if np.all(alwaysMasked[i, :]):
-                rmCol.append(i)
-
-        for i in range(len(self.data[0, 0, :])):
-            if np.all(alwaysMasked[:, i]):
-                rmRow.append(i)
-
-        for idxToRemove in reversed(rmRow):
-            self.data = self.data[:, np.arange(
-                len(self.data[0, :, 0])) != idxToRemove, :]
-            self.lons = np.delete(self.lons, idxToRemove)
-
-        for idxToRemove in reversed(rmCol):
-            self.data = self.data[:, np.arange(
-                len(self.data[0, 0, :])) != idxToRemove, :]
-            self.lats = np.delete(self.lats, idxToRemove)
+        '''
+        Crops the border rows and columns of the satellite data that are masked at every time step
+        '''
+        mask = np.ma.getmask(self.data)
+        if mask is np.ma.nomask:
+            return
+
+        alwaysMasked = np.all(mask, axis=0)
+        rows = np.flatnonzero(~np.all(alwaysMasked, axis=1))
+        cols = np.flatnonzero(~np.all(alwaysMasked, axis=0))
+        if len(rows) == 0:
+            return
+
+        rows = slice(rows[0], rows[-1] + 1)
+        cols = slice(cols[0], cols[-1] + 1)
+        self.data = self.data[:, rows, cols]
+        self.lats = self.lats[rows]
+        self.lons = self.lons[cols]
 
         # If you want to see all the gaps along the time of the satelite data, just uncomment and plot
-        # for i in range(len(self.data)):
-        #    self.data[i,:,:].mask = ~alwaysFilled
+        # alwaysFilled = ~np.any(mask, axis=0)
+        # self.data.mask[:] = ~alwaysFilled
 
     def reduceSizeSpace(self):
+        '''
+        Crops both grids to their common bounding box: the model to the satellite domain and the
+        satellite data to the cropped model domain
+        '''
         print("\nRemoving excess space...")
-        # Cut out excessive spacial data
-        minLon = findClose(self.lons, self.RefSet.lons[0], end='min')
-        maxLon = 270  # findClose(self.lons, self.RefSet.lons[-1], end = 'max')
-        minLat = 35  # findClose(self.lats, self.RefSet.lats[0], end = 'min')
-        maxLat = findClose(self.lats, self.RefSet.lats[-1], end='max')
-        self.data = self.data[:, minLat: maxLat, minLon: maxLon]
-        self.lons = self.lons[minLon: maxLon]
-        self.lats = self.lats[minLat: maxLat]
-        self.RefSet.data = self.RefSet.data[:, 1: 54, 10:100]
-        self.RefSet.lats = self.RefSet.lats[1: 54]
-        self.RefSet.lons = self.RefSet.lons[10: 100]
-        self.regionLabels = self.regionLabels[1: 54, 10:100]
+        rows, cols = gridWindow(self.RefSet.lons, self.RefSet.lats, gridBounds(self.lons, self.lats))
+        self.RefSet.data = self.RefSet.data[:, rows, cols]
+        self.RefSet.lats = self.RefSet.lats[rows]
+        self.RefSet.lons = self.RefSet.lons[cols]
+        self.regionLabels = self.regionLabels[rows, cols]
+
+        rows, cols = gridWindow(self.lons, self.lats, gridBounds(self.RefSet.lons, self.RefSet.lats))
+        self.data = self.data[:, rows, cols]
+        self.lats = self.lats[rows]
+        self.lons = self.lons[cols]
         print("Sat shape", np.shape(self.data))
         print("Model shape", np.shape(self.RefSet.data))
 
 
     def removeLandPixels(self):
-        # Remove values that are on mainland or lakes
+        # Remove values that are on mainland or lakes (the masks are cached, see landmask.py)
 
         print("Removing values on mainland and lakes...\n")
 
-        lats, lons = np.meshgrid(self.lats, self.lons)
-
-        isLand = globe.is_land(lats.T, lons.T)
-
-        for k in range(len(self.data)):
-            self.data[k].mask = isLand | self.data[k].mask
-
-        latsRef, lonsRef = np.meshgrid(self.RefSet.lats, self.RefSet.lons)
-        isLand = globe.is_land(latsRef.T, lonsRef.T)
+        apply_mask(self.data, land_mask(self.lons, self.lats))
+        apply_mask(self.RefSet.data, land_mask(self.RefSet.lons, self.RefSet.lats))
 
-        for k in range(len(self.RefSet.data)):
-            self.RefSet.data[k].mask = isLand | self.RefSet.data[k].mask
-
-        lats, lons = np.meshgrid(self.lons, self.lats)
-        latsRef, lonsRef = np.meshgrid(self.RefSet.lons, self.RefSet.lats)
-
-        newMask = griddata((lonsRef.flatten(), latsRef.flatten()), self.RefSet.data[0].mask.flatten(), (lons, lats), method='nearest')
-
-        for k in range(len(self.data)):
-            self.data[k].mask = newMask | self.data[k].mask
+        # Pixels outside the model domain
+        newMask = transfer_mask(np.ma.getmaskarray(self.RefSet.data[0]), self.RefSet.lons, self.RefSet.lats,
+                                self.lons, self.lats)
+        apply_mask(self.data, newMask)
 
         print("Finished preprocessing.\n")
 
@@ -247,6 +294,7 @@ class SateliteData(DataSet):
     def mapLabels(self, labels_model, lons_lats_model):
         '''
         Use nearest neighbour interpolation to map the given labels to the satellite set.
+        The interpolation operator is cached (see regrid.Regridder).
 
         labels_model :      Numpy array defined over the spatial coordinates of lons_lats_model.
         lons_lats_model :   Numpy array of spatial coordinates.
@@ -254,20 +302,36 @@ class SateliteData(DataSet):
 
         print("\nMapping labels from the model data to the satelite coordinates...")
 
-        lats, lons = np.meshgrid(self.lons, self.lats)
-        latsRef = lons_lats_model[:,:,0].flatten()
-        lonsRef = lons_lats_model[:,:,1].flatten()
+        regridder = Regridder.build(lons_lats_model[0, :, 0], lons_lats_model[:, 0, 1], self.lons, self.lats,
+                                    method='nearest')
+        return regridder(labels_model)
+
+    def regridToModel(self, method='conservative'):
+        '''
+        Returns the satellite data on the model grid, shape (time, model lat, model lon)
+
+        method: 'conservative' (area weighted average of the satellite pixels), 'bilinear' or 'nearest'
+        '''
+        return Regridder.build(self.lons, self.lats, self.RefSet.lons, self.RefSet.lats, method=method)(self.data)
+
+    def regridModel(self, method='bilinear'):
+        '''
+        Returns the model data on the satellite grid, shape (time, satellite lat, satellite lon)
+
+        method: 'bilinear', 'nearest' or 'conservative'
+        '''
+        return Regridder.build(self.RefSet.lons, self.RefSet.lats, self.lons, self.lats, method=method)(self.RefSet.data)
 
-        return griddata((lonsRef, latsRef), labels_model.flatten(), (lons, lats), method='nearest')
 
 def clustervaluesSat(satData, satLabels, modelLabels, lon = 8.6865, lat = 54.025):
     '''
     Function to plot the yearly mean of two cuantities of a certain cluster. The preset values correspong
     to the river estuary of the Elba, Weser and Rhine rivers.
+    The means are computed with regions.region_series (cached).
 
-    matrix:     Matrix [timesteps, lons, lats] containing the unmodified model values.
-    labels:     Labels of the clustering algorithm.
-    lons_lats:  Spatial coordinates of the form [:,:,0:1].
+    satData:    SateliteData instance, with the model data in satData.RefSet.
+    satLabels:  Labels of the clustering algorithm on the satellite grid (see mapLabels).
+    modelLabels: Labels of the clustering algorithm on the model grid.
     lon:        Longitude of a point within the cluster of interest.
     lat:        Latitude of a point within the cluster of interest.
     '''
@@ -275,51 +339,14 @@ def clustervaluesSat(satData, satLabels, modelLabels, lon = 8.6865, lat = 54.025
     if not isinstance(satData, SateliteData):
                 raise TypeError("Please provide SateliteData instance as input...")
 
-    n = len(satData.times)
-
-    # Compute stuff for satelite data
-    lonEstuary = findClose(satData.lons, lon, end = 'min')
-    latEstuary = findClose(satData.lats, lat, end = 'min', reverse = True)
-    label_estuary_satelite = satLabels[latEstuary,lonEstuary]
-    idxSat = np.where(satLabels == label_estuary_satelite)
-
-    # Compute stuff for model data
-    lonEstuary = findClose(satData.RefSet.lons, lon, end = 'min')
-    latEstuary = findClose(satData.RefSet.lats, lat, end = 'min')
-    label_estuary_model = modelLabels[latEstuary,lonEstuary]
-    idxModel = np.where(modelLabels == label_estuary_satelite)
-
-    satCHL = list()
-    modelCHL = list()
-    dates = [satData.times[0].year]
-    datesIdx = [satData.times[0].year]
-    years = np.array([date.year for date in satData.times])
-
-    rawSatCHL = satData.data
-    rawModelCHL = satData.RefSet.data
-    meanSatCHL = np.zeros(n)
-    meanModelCHL = np.zeros(n)
-
-    for k in range(n):
-        datesIdx.append(satData.times[k].year)
-
-        if int(dates[-1]) < satData.times[k].year:
-            dates.append(satData.times[k].year)
-
-        tmp = rawSatCHL[k]
-        meanSatCHL[k] = np.nanmean(tmp[idxSat])
-        tmp = rawModelCHL[k]
-        meanModelCHL[k] = np.nanmean(tmp[idxModel])
-    
-    datesIdx.pop(-1)
-    datesIdx = np.array(datesIdx)
-
-    for k in dates:
-        satCHL.append(np.mean(meanSatCHL[np.where(datesIdx == k)]))
-        modelCHL.append(np.mean(meanModelCHL[np.where(datesIdx == k)]))
+    # Cluster of the location on both grids
+    label_estuary_satelite = label_at(satLabels, satData.lons, satData.lats, lon, lat)
+    label_estuary_model = label_at(modelLabels, satData.RefSet.lons, satData.RefSet.lats, lon, lat)
 
-    satCHL = np.array(satCHL)
-    modelCHL = np.array(modelCHL)
+    satCHL, years = region_series(satData.data, satLabels, satData.times, freq='year', region=label_estuary_satelite)
+    modelCHL = region_series(satData.RefSet.data, modelLabels, satData.RefSet.times, freq='year',
+                             region=label_estuary_model)[0]
+    dates = (years.astype('datetime64[Y]').astype(int) + 1970).tolist()
 
     fig, ax = plt.subplots(figsize = (8,6))
 
@@ -352,38 +379,23 @@ def __main__():
     #with np.load('lons_lats.npz') as ll:
     #    lons_lats = ll['lons_lats']
 
-    #try:
-    #    with np.load('region_labels.npz') as r_labels:
-    #        region_labels = r_labels['matrix']
-    #except:
-    #    region_labels = region_calculation(
-    #        n_regions=4, show_silhouette=True)
-    #    np.savez_compressed('region_labels.npz', matrix=region_labels)
+    #region_labels = region_calculation(n_regions=4, show_silhouette=True)
 
     #satLabels = sat1.mapLabels(region_labels,lons_lats)
 
     #clustervaluesSat(sat1, satLabels, sat1.regionLabels, lon = 8.6865, lat = 54.025)
 
-    satData = np.asarray(sat1.data)
-    satData = np.where(sat1.data.mask, np.nan, satData)
+    # Fill the cloud gaps with the mean of the previous and next days (see gapfill.fill_gaps)
+    satData = fill_gaps(sat1.data, method='window', k=1)
 
     modelData = np.asarray(sat1.RefSet.data)
     modelData = np.where(sat1.RefSet.data.mask, np.nan, modelData)
 
-    for i in range(satData.shape[0]):
-        if i < satData.shape[0] - 1 and i > 0:
-            idxWhereNan = np.where(np.isnan(satData[i, :, :]) & (~np.isnan(satData[i-1, :, :]) | ~np.isnan(satData[i+1,:,:])))
-            if not idxWhereNan[0].size == 0:
-                tmp = satData[i-1, :, :]
-                tmp2 = satData[i, :, :]
-                tmp3 = satData[i+1, :, :]
-                tmp2[idxWhereNan] = np.nanmean([tmp[idxWhereNan], tmp2[idxWhereNan], tmp3[idxWhereNan]], axis = 0)
-                satData[i, :, :] = tmp2
-
-        a = satData[i,:,:]
-        satData[i,:,:]= (a-np.full(a.shape,np.amin(a[~np.isnan(a)])))/(np.amax(a[~np.isnan(a)])-np.amin(a[~np.isnan(a)]))
-        b = modelData[i,:,:]
-        modelData[i,:,:]= (b-np.full(b.shape,np.amin(b[~np.isnan(b)])))/(np.amax(b[~np.isnan(b)])-np.amin(b[~np.isnan(b)]))
+    # Daily min-max scaling of both datasets, in place (see normalization.Normalizer)
+    satNormalizer = Normalizer('minmax', 'day')
+    satNormalizer.fit_transform(satData)
+    modelNormalizer = Normalizer('minmax', 'day')
+    modelNormalizer.fit_transform(modelData)
 
     from clustering import single_chemical_clustering
     [cl_data_sat, labels_sat, cl_sizes_sat, s_avg] = single_chemical_clustering(matrix = satData,\
@@ -6,108 +6,170 @@ from scipy import stats
 import datetime as dt
 import sys
 import pickle
+from cube_store import ChunkedCube, open_matrix
+from running_stats import RunningStats, stats_path
+from normalization import Normalizer, normalization_path
 
-datasets = []
 
-
-# Modes of rescaling the data:
+# Modes of rescaling the data (see normalization.Normalizer.from_mode):
 # 0to1_dayly:   scales the data linearly from 0 to 1; 0 is daily min and 1 is daily max
 # zscores:      scales the data based on daily zscores
+# method_scope: e.g. minmax_pixel or zscore_global, with the statistics of every pixel or of the whole record
 mode = '0to1_dayly'
 
-# Loading data from datasets
-path_to_files = os.path.abspath('')+'\MetO-NWS-BIO-dm-'
-extension = ".nc"
-
-chl_path = path_to_files + "CHL" + extension
-datasets.append(Dataset(chl_path, mode='r'))
-doxy_path = path_to_files + "DOXY" + extension
-datasets.append(Dataset(doxy_path, mode='r'))
-nitr_path = path_to_files + "NITR" + extension
-datasets.append(Dataset(nitr_path, mode='r'))
-phos_path = path_to_files + "PHOS" + extension
-datasets.append(Dataset(phos_path, mode='r'))
-
-# Printing the keys (not relevant)
-keys = []
-keys.append(list(datasets[0].variables)[1])
-keys.append(list(datasets[1].variables)[0])
-keys.append(list(datasets[2].variables)[0])
-keys.append(list(datasets[3].variables)[1])
-
-print(keys)
-
-
-# Transforming tha dates into datetime dates (not saved)
-time = datasets[0].variables['time']
-jd = netCDF4.num2date(time[:], time.units)
-d = []
-for dd in jd:
-    d.append(dt.date(dd.year, dd.month, dd.day))
-
-# Loading the langitudes and latitudes data
-lons = datasets[0].variables['longitude'][:]
-lats = datasets[0].variables['latitude'][:]
-
-lons, lats = np.meshgrid(lons, lats)
-
-# Storing relevant data in a different List
-data = []
-for i in range(4):
-    data.append(np.squeeze(datasets[i].variables[keys[i]][:]))
-
-# Closing opened datasets
-for i in range(4):
-    datasets[i].close()
-
-# Transforming the data in a np.array
-matrix = np.zeros((data[0].shape[0], data[0].shape[1], data[0].shape[2], 4))
-matrix[:, :, :, 0] = np.asarray(data[0])
-matrix[:, :, :, 1] = np.asarray(data[1])
-matrix[:, :, :, 2] = np.asarray(data[2])
-matrix[:, :, :, 3] = np.asarray(data[3])
-
-matrix = np.where(matrix < 0, np.nan, matrix)
-
-# Performing standardization
-if mode == 'zscore':
-    for i in range(matrix.shape[0]):
-        a = matrix[i, :, :, 0]
-        matrix[i, :, :, 0] = (
-            a - np.full(a.shape, np.mean(a[~np.isnan(a)])))/np.std(a[~np.isnan(a)])
-        a = matrix[i, :, :, 1]
-        matrix[i, :, :, 1] = (
-            a - np.full(a.shape, np.mean(a[~np.isnan(a)])))/np.std(a[~np.isnan(a)])
-        a = matrix[i, :, :, 2]
-        matrix[i, :, :, 2] = (
-            a - np.full(a.shape, np.mean(a[~np.isnan(a)])))/np.std(a[~np.isnan(a)])
-        a = matrix[i, :, :, 3]
-        matrix[i, :, :, 3] = (
-            a - np.full(a.shape, np.mean(a[~np.isnan(a)])))/np.std(a[~np.isnan(a)])
-elif mode == '0to1_dayly':
-    for i in range(matrix.shape[0]):
-        a = matrix[i, :, :, 0]
-        matrix[i, :, :, 0] = (
-            a - np.full(a.shape, np.amin(a[~np.isnan(a)])))/(np.amax(a[~np.isnan(a)]) - np.amin(a[~np.isnan(a)]))
-        a = matrix[i, :, :, 1]
-        matrix[i, :, :, 1] = (
-            a - np.full(a.shape, np.amin(a[~np.isnan(a)])))/(np.amax(a[~np.isnan(a)]) - np.amin(a[~np.isnan(a)]))
-        a = matrix[i, :, :, 2]
-        matrix[i, :, :, 2] = (
-            a - np.full(a.shape, np.amin(a[~np.isnan(a)])))/(np.amax(a[~np.isnan(a)]) - np.amin(a[~np.isnan(a)]))
-        a = matrix[i, :, :, 3]
-        matrix[i, :, :, 3] = (
-            a - np.full(a.shape, np.amin(a[~np.isnan(a)])))/(np.amax(a[~np.isnan(a)]) - np.amin(a[~np.isnan(a)]))
-
-# Transforming lat and lon data in a np.array
-lons_lats = np.zeros((lons.shape[0], lons.shape[1], 2))
-lons_lats[:, :, 0] = np.asarray(lons)
-lons_lats[:, :, 1] = np.asarray(lats)
-
-# Saving the data
-np.savez_compressed('model_data.npz', matrix=matrix)
-np.savez_compressed('lons_lats.npz', lons_lats=lons_lats)
-
-# Saving dates using pickle
-with open("datetimes.txt", "wb") as fp:
-    pickle.dump(d, fp)
+# Number of days read, cleaned and written at once when streaming (None loads the whole record)
+chunk_size = 360
+
+# Shape of the blocks of the saved cube (time, lat, lon, chemical) and their compression
+cube_chunks = (30, 64, 64, 1)
+compression = 'zlib'
+
+# Order of the chemicals in the last axis of the saved matrix
+chemical_names = ['CHL', 'DOXY', 'NITR', 'PHOS']
+
+
+def open_datasets(path_to_files=os.path.abspath('MetO-NWS-BIO-dm-'), extension='.nc'):
+    '''
+    Opens the four model datasets and returns them together with the key of the stored quantity
+
+    path_to_files:  common path prefix of the datasets
+    extension:      file extension of the datasets
+    '''
+    datasets = []
+    for name in chemical_names:
+        datasets.append(Dataset(path_to_files + name + extension, mode='r'))
+
+    # For CHL and PHOS the first variable is the depth
+    keys = []
+    keys.append(list(datasets[0].variables)[1])
+    keys.append(list(datasets[1].variables)[0])
+    keys.append(list(datasets[2].variables)[0])
+    keys.append(list(datasets[3].variables)[1])
+
+    return datasets, keys
+
+
+def read_chunk(datasets, keys, t1, t2, dtype=np.float64):
+    '''
+    Reads the days t1 to t2 (excluded) of every chemical and returns them as a cleaned
+    matrix of shape (t2 - t1, lat, lon, chemical), where negative and masked values are NaN
+
+    datasets:   opened datasets (see open_datasets)
+    keys:       keys of the quantities stored in the datasets
+    t1, t2:     time range to read
+    dtype:      data type of the returned matrix
+    '''
+    n_lats = datasets[0].variables['latitude'].shape[0]
+    n_lons = datasets[0].variables['longitude'].shape[0]
+
+    chunk = np.empty((t2 - t1, n_lats, n_lons, len(datasets)), dtype=dtype)
+    for i in range(len(datasets)):
+        data = datasets[i].variables[keys[i]][t1:t2]
+        chunk[:, :, :, i] = np.ma.filled(data.astype(dtype), np.nan).reshape(
+            (t2 - t1, n_lats, n_lons))
+
+    chunk[chunk < 0] = np.nan
+
+    return chunk
+
+
+def save_model_data(name='model_data', mode=mode, chunk_size=chunk_size, dtype=np.float64,
+                    chunks=cube_chunks, compression=compression):
+    '''
+    Reads the model datasets, cleans and standardizes them and saves them together with
+    the coordinates (lons_lats.npz) and the dates (datetimes.txt)
+
+    name:       name of the saved matrix
+    mode:       standardization mode (see normalization.Normalizer.from_mode). The parameters
+                are saved next to the matrix (see normalization.normalization_path) so that
+                the data can be denormalized
+    chunk_size: number of days processed at once. The matrix is streamed chunk by chunk into
+                the cube 'name' (see cube_store.ChunkedCube) so that the memory used only
+                depends on chunk_size. The per-pixel statistics of the record are saved
+                next to the cube (see running_stats.cached_stats).
+                If None the whole record is loaded at once and saved in name.npz
+    dtype:      data type of the saved matrix
+    chunks:     shape of the blocks of the cube
+    compression: 'zlib' or None (uncompressed and memory-mapped)
+    '''
+    datasets, keys = open_datasets()
+
+    # Printing the keys (not relevant)
+    print(keys)
+
+    # Transforming tha dates into datetime dates (not saved)
+    time = datasets[0].variables['time']
+    jd = netCDF4.num2date(time[:], time.units)
+    d = []
+    for dd in jd:
+        d.append(dt.date(dd.year, dd.month, dd.day))
+
+    # Loading the langitudes and latitudes data
+    lons = datasets[0].variables['longitude'][:]
+    lats = datasets[0].variables['latitude'][:]
+
+    lons, lats = np.meshgrid(lons, lats)
+
+    n_days = len(d)
+    normalizer = Normalizer.from_mode(mode)
+    if chunk_size is None:
+        matrix = read_chunk(datasets, keys, 0, n_days, dtype=dtype)
+        if normalizer is not None:
+            normalizer.fit_transform(matrix, chunk_size=n_days)
+        np.savez_compressed(name + '.npz', matrix=matrix)
+    else:
+        matrix = ChunkedCube.create(name, (n_days, lons.shape[0], lons.shape[1], len(datasets)),
+                                    dtype=dtype, chunks=chunks, compression=compression)
+        # The per-pixel and global statistics need a first pass over the record
+        if normalizer is not None and normalizer.scope != 'day':
+            for t1 in range(0, n_days, chunk_size):
+                normalizer.partial_fit(read_chunk(datasets, keys, t1, min(t1 + chunk_size, n_days), dtype=dtype))
+        stats = RunningStats()
+        for t1 in range(0, n_days, chunk_size):
+            t2 = min(t1 + chunk_size, n_days)
+            chunk = read_chunk(datasets, keys, t1, t2, dtype=dtype)
+            if normalizer is not None:
+                if normalizer.scope == 'day':
+                    normalizer.partial_fit(chunk)
+                normalizer.transform(chunk, start=t1)
+            matrix[t1:t2] = chunk
+            stats.update(chunk)
+            print("Saved days " + str(t1) + " - " + str(t2) + " of " + str(n_days))
+        matrix.flush()
+
+        # Per-pixel statistics of the whole record, saved next to the cube
+        stats.save(stats_path(name))
+
+    if normalizer is not None:
+        normalizer.save(normalization_path(name))
+
+    del matrix
+
+    # Closing opened datasets
+    for i in range(len(datasets)):
+        datasets[i].close()
+
+    # Transforming lat and lon data in a np.array
+    lons_lats = np.zeros((lons.shape[0], lons.shape[1], 2))
+    lons_lats[:, :, 0] = np.asarray(lons)
+    lons_lats[:, :, 1] = np.asarray(lats)
+
+    # Saving the data
+    np.savez_compressed('lons_lats.npz', lons_lats=lons_lats)
+
+    # Saving dates using pickle
+    with open("datetimes.txt", "wb") as fp:
+        pickle.dump(d, fp)
+
+
+def load_model_data(name='model_data'):
+    '''
+    Opens the matrix saved by save_model_data without loading it (see cube_store.open_matrix)
+
+    name:   name of the saved matrix
+    '''
+    return open_matrix(name)
+
+
+if __name__ == "__main__":
+    save_model_data(mode=mode, chunk_size=chunk_size)
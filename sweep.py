@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from clustering import clustering
+from pixel_index import OceanPixelIndex
+from validation import centroid_metrics
+from parallel import share_array, attach_worker, worker_arrays
+
+
+def sweep_grid(modes=['kmeans'], n_clusters=[4], eps=[1], timesteps=[None], chemicals=[None]):
+    '''
+    Returns the list of parameter combinations of a sweep. kmeans and hierarchical are swept over
+    n_clusters, dbscan over eps.
+
+    modes:      clustering modes (kmeans, dbscan, hierarchical)
+    n_clusters: numbers of clusters for kmeans and hierarchical
+    eps:        maximal neighboring distances for dbscan
+    timesteps:  timesteps clustered spatially (see timestep_clustering)
+    chemicals:  chemicals whose time series are clustered (see single_chemical_clustering).
+                If both timestep and chemical are None the matrix is clustered as it is,
+                shape (n_samples, n_features)
+    '''
+    # numpy scalars (e.g. from np.arange) are not JSON serializable (see point_key)
+    def python_values(values):
+        return [v.item() if isinstance(v, np.generic) else v for v in values]
+
+    modes, n_clusters, eps = python_values(modes), python_values(n_clusters), python_values(eps)
+    timesteps, chemicals = python_values(timesteps), python_values(chemicals)
+    grid = []
+    for mode, timestep, chemical in itertools.product(modes, timesteps, chemicals):
+        if mode == 'dbscan':
+            for e in eps:
+                grid.append(dict(mode=mode, n_clusters=None, eps=e, timestep=timestep, chemical=chemical))
+        else:
+            for k in n_clusters:
+                grid.append(dict(mode=mode, n_clusters=k, eps=None, timestep=timestep, chemical=chemical))
+    return grid
+
+
+def point_key(params):
+    '''
+    Returns the key identifying a point of the sweep in the results file
+    '''
+    return json.dumps(params, sort_keys=True)
+
+
+def sweep_features(matrix, timestep=None, chemical=None):
+    '''
+    Returns the feature matrix clustered at a point of the sweep
+
+    matrix:     the data (see sweep_grid)
+    timestep:   timestep clustered spatially
+    chemical:   chemical whose time series are clustered
+    '''
+    if timestep is not None:
+        frame = matrix[timestep]
+        return OceanPixelIndex.from_frame(frame).frame_to_features(frame)
+    if chemical is not None:
+        series = matrix[:, :, :, chemical] if matrix.ndim == 4 else matrix
+        return OceanPixelIndex.from_series(series).series_to_features(series)
+    return np.asarray(matrix, dtype=np.float64)
+
+
+def fit_sweep_point(params):
+    '''
+    Pool task of run_sweep: fits one point of the sweep on the shared matrix and returns its
+    row of results (the parameters, the inertia, the centroid validation metrics and the fit time)
+
+    params: parameters of the point (see sweep_grid)
+    '''
+    matrix = worker_arrays['matrix'][1]
+    data = sweep_features(matrix, timestep=params['timestep'], chemical=params['chemical'])
+
+    start = time.time()
+    if params['mode'] == 'dbscan':
+        model = clustering(data=data, mode='dbscan', dbscan_epsilon=params['eps'], verbose=False)
+    else:
+        model = clustering(data=data, n_clusters=params['n_clusters'], mode=params['mode'], verbose=False)
+    fit_time = time.time() - start
+
+    metrics = centroid_metrics(data=data, labels=model.labels_,
+                               centroids=getattr(model, 'cluster_centers_', None))
+    if hasattr(model, 'inertia_'):
+        metrics['inertia'] = model.inertia_
+
+    row = dict(params)
+    row.update({key: float(value) for key, value in metrics.items()})
+    row['n_clusters_found'] = int(np.max(model.labels_)) + 1
+    row['fit_time'] = fit_time
+    return row
+
+
+def load_results(results_path):
+    '''
+    Reads the rows of a results file written by run_sweep. A last line cut off by an interrupted
+    write is removed from the file, so that the sweep can resume; other unreadable lines are skipped.
+    '''
+    rows = []
+    if results_path is not None and os.path.exists(results_path):
+        with open(results_path, 'rb+') as fp:
+            end = 0
+            for line in fp:
+                start, end = end, end + len(line)
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    if not line.endswith(b'\n'):
+                        fp.truncate(start)
+                        break
+                    continue
+                if not line.endswith(b'\n'):
+                    # Complete last row without its line end: the next row goes on a new line
+                    fp.seek(0, os.SEEK_END)
+                    fp.write(b'\n')
+    return rows
+
+
+def run_sweep(matrix=None, grid=None, results_path='sweep_results.jsonl', n_workers=None, callback=None):
+    '''
+    Fits every point of the grid in a process pool and returns the table of results as a list of
+    rows (dictionaries), in the order of the grid. The matrix is shared read-only with the workers
+    through shared memory. Every row is appended to results_path as soon as it is computed, and
+    the points already in results_path are not fitted again, so interrupted sweeps resume.
+
+    matrix:         the data (see sweep_grid)
+    grid:           list of parameter combinations (see sweep_grid)
+    results_path:   file of the results, one JSON row per line (None keeps them in memory only)
+    n_workers:      number of worker processes (None uses all cores)
+    callback:       optional function called with every new row as soon as it is computed
+    '''
+    results = {point_key({key: row[key] for key in grid[0]}): row
+               for row in load_results(results_path)} if len(grid) > 0 else {}
+    todo = [params for params in grid if point_key(params) not in results]
+
+    if len(todo) > 0:
+        # The mask of a masked matrix is not shared, the masked values become NaN
+        shm, descriptor = share_array(np.ma.filled(np.ma.asarray(matrix).astype(np.float64), np.nan))
+        fp = open(results_path, 'a') if results_path is not None else None
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=attach_worker,
+                                     initargs=(dict(matrix=descriptor),)) as pool:
+                tasks = [pool.submit(fit_sweep_point, params) for params in todo]
+                for task in as_completed(tasks):
+                    row = task.result()
+                    results[point_key({key: row[key] for key in grid[0]})] = row
+                    if fp is not None:
+                        fp.write(json.dumps(row) + '\n')
+                        fp.flush()
+                    if callback is not None:
+                        callback(row)
+        finally:
+            if fp is not None:
+                fp.close()
+            shm.close()
+            shm.unlink()
+
+    return [results[point_key(params)] for params in grid]
+
+
+def sweep_series(rows, metric='inertia', **filters):
+    '''
+    Extracts a metric as a function of the number of clusters (or eps for dbscan) from the
+    results of run_sweep, e.g. for elbowPlot:
+        n_clusters, inertia = sweep_series(rows, 'inertia', mode='kmeans', timestep=0)
+        elbowPlot(inertia, n_clusters)
+
+    rows:       results of run_sweep
+    metric:     column of the results
+    filters:    values the other parameters must have
+    '''
+    selected = [row for row in rows if all(row[key] == value for key, value in filters.items())]
+    x_key = 'eps' if len(selected) > 0 and selected[0]['mode'] == 'dbscan' else 'n_clusters'
+    selected.sort(key=lambda row: row[x_key])
+    return np.array([row[x_key] for row in selected]), np.array([row[metric] for row in selected])
@@ -0,0 +1,47 @@
+import importlib
+import linecache
+import numpy as np
+from result_cache import ResultStore, memoize, fingerprint
+
+
+def test_memmap_slices_have_different_keys(tmp_path):
+    matrix = np.memmap(str(tmp_path / 'matrix.dat'), dtype=np.float64, mode='w+', shape=(10, 4, 2))
+    matrix[:] = np.random.default_rng(0).random(matrix.shape)
+    matrix.flush()
+    matrix = np.memmap(str(tmp_path / 'matrix.dat'), dtype=np.float64, mode='r', shape=(10, 4, 2))
+
+    keys = [fingerprint(matrix[..., 0]), fingerprint(matrix[..., 1]),
+            fingerprint(matrix[0:5]), fingerprint(matrix[5:10]), fingerprint(matrix)]
+    assert len(set(keys)) == len(keys)
+    assert fingerprint(matrix[..., 1]) == fingerprint(matrix[..., 1])
+
+    @memoize(store=ResultStore(str(tmp_path / 'results')))
+    def mean(values):
+        return float(np.mean(values))
+
+    for i in range(2):
+        assert mean(matrix[..., i]) == float(np.mean(matrix[..., i]))
+    assert mean(matrix[5:10]) == float(np.mean(matrix[5:10]))
+
+
+def test_dependency_changes_invalidate_results(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / 'dependency.py').write_text('def scale(x):\n    return 2 * x\n')
+    import dependency
+
+    @memoize(depends=('dependency',), store=ResultStore(str(tmp_path / 'results')))
+    def scaled(x):
+        return dependency.scale(x)
+
+    assert scaled(3) == 6
+
+    # A new process would import the edited module; the key follows its code
+    (tmp_path / 'dependency.py').write_text('def scale(x):\n    return 3 * x\n')
+    linecache.clearcache()
+    importlib.reload(dependency)
+
+    @memoize(depends=('dependency',), store=ResultStore(str(tmp_path / 'results')))
+    def scaled(x):
+        return dependency.scale(x)
+
+    assert scaled(3) == 9
@@ -2,17 +2,87 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import cm
 from itertools import compress
-from sklearn.metrics import silhouette_score, silhouette_samples
+from sklearn.metrics import pairwise_distances_chunked
 from scipy.cluster.hierarchy import dendrogram
 
-def silhouette_plot(labels=None, data=None, name_model='', plotGraph=False, n_clusters=0):
+def stratified_sample(labels=None, sample_size=1000, random_state=0):
+    '''
+    Returns the indexes of a random sample of about sample_size samples, drawn from every cluster
+    proportionally to its size (at least one sample per cluster). NaN and negative labels are not sampled.
+
+    labels:         labels of clustering model
+    sample_size:    number of samples to draw
+    random_state:   seed of the sampling
+    '''
+    labels = np.asarray(labels, dtype=np.float64)
+    rng = np.random.default_rng(random_state)
+    valid = np.flatnonzero(labels >= 0)
+    if len(valid) <= sample_size:
+        return valid
+
+    sample = []
+    for k in np.unique(labels[valid]):
+        members = valid[labels[valid] == k]
+        n = max(1, int(round(sample_size * len(members) / len(valid))))
+        sample.append(rng.choice(members, size=min(n, len(members)), replace=False))
+    return np.sort(np.concatenate(sample))
+
+
+def silhouette_values(data=None, labels=None, metric='euclidean', working_memory=None):
+    '''
+    Returns the silhouette coefficient of every sample, computing the pairwise distances once in
+    chunks of bounded memory. Samples with NaN or negative labels (noise) get NaN; samples of
+    single-sample clusters get 0.
+
+    data:           data where the model is applied, shape (n_samples, n_features)
+    labels:         labels of clustering model
+    metric:         distance metric
+    working_memory: memory (in MB) of a chunk of distances (default sklearn's working_memory)
+    '''
+    data = np.asarray(data, dtype=np.float64)
+    labels = np.asarray(labels, dtype=np.float64)
+    s_samples = np.full(len(labels), np.nan)
+
+    valid = np.flatnonzero(labels >= 0)
+    if len(valid) == 0:
+        return s_samples
+    clusters, codes = np.unique(labels[valid], return_inverse=True)
+    if len(clusters) < 2:
+        return s_samples
+
+    # Sum of the distances of every sample to the members of every cluster
+    one_hot = np.zeros((len(valid), len(clusters)))
+    one_hot[np.arange(len(valid)), codes] = 1
+    sums = np.concatenate(list(pairwise_distances_chunked(
+        data[valid], metric=metric, working_memory=working_memory,
+        reduce_func=lambda chunk, start: chunk @ one_hot)))
+
+    sizes = one_hot.sum(axis=0)
+    own = sums[np.arange(len(valid)), codes]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        a = own / (sizes[codes] - 1)
+        mean_others = sums / sizes
+    mean_others[np.arange(len(valid)), codes] = np.inf
+    b = np.min(mean_others, axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        s = (b - a) / np.maximum(a, b)
+    s[sizes[codes] == 1] = 0
+    s_samples[valid] = np.nan_to_num(s)
+
+    return s_samples
+
+
+def silhouette_plot(labels=None, data=None, name_model='', plotGraph=False, n_clusters=0, sample_size=None, random_state=0):
     '''Returns the silhouette metric and the respective graph (if required):
     
-    labels:     Labels of clustering model
-    data:       data where the model is applied
-    plotGraph:  (default False)
-    name_model: Name of the evaluated model
-    n_clusters: number of clusters
+    labels:         Labels of clustering model
+    data:           data where the model is applied
+    plotGraph:      (default False)
+    name_model:     Name of the evaluated model
+    n_clusters:     number of clusters
+    sample_size:    if not None, the silhouette is estimated on a stratified sample of this size
+    random_state:   seed of the sampling
 
     s_avg  : Average silhouette metric for the clustering model
     '''
@@ -23,9 +93,16 @@ def silhouette_plot(labels=None, data=None, name_model='', plotGraph=False, n_cl
     elif n_clusters == 1:
         return 1
 
+    labels = np.asarray(labels, dtype=np.float64)
+    data = np.asarray(data)
+    if sample_size is not None:
+        sample = stratified_sample(labels, sample_size=sample_size, random_state=random_state)
+        labels = labels[sample]
+        data = data[sample]
+
     # Calculations
-    s_samples = silhouette_samples(X=data, labels=labels)
-    s_avg = silhouette_score(X=data, labels=labels)
+    s_samples = silhouette_values(data=data, labels=labels)
+    s_avg = np.nanmean(s_samples) if (~np.isnan(s_samples)).any() else np.nan
 
     # Plotting of the silhouettes
     if plotGraph:
@@ -68,17 +145,115 @@ def silhouette_plot(labels=None, data=None, name_model='', plotGraph=False, n_cl
     return s_avg
 
 
+def centroid_metrics(data=None, labels=None, centroids=None, batch_size=65536):
+    '''
+    Returns a dictionary of fast O(n·k) validation metrics of a clustering, computed from the
+    distances of every sample to every centroid in one batched pass:
+
+    inertia:            sum of the squared distances of the samples to their centroid
+    silhouette:         simplified silhouette, using the distances to the own and to the nearest
+                        other centroid instead of the mean distances to the members
+    calinski_harabasz:  ratio of the between- and within-cluster dispersions (higher is better)
+    davies_bouldin:     mean similarity of every cluster with its most similar one (lower is better)
+
+    data:       data where the model is applied, shape (n_samples, n_features)
+    labels:     labels of clustering model; NaN and negative labels (noise) are ignored
+    centroids:  centroids of the clusters, shape (n_clusters, n_features), e.g. cluster_centers_
+                of kmeans. By default the mean of the members of every cluster.
+    batch_size: number of samples processed at once
+    '''
+    data = np.asarray(data, dtype=np.float64)
+    labels = np.asarray(labels, dtype=np.float64)
+    valid = labels >= 0
+    data = data[valid]
+    codes = labels[valid].astype(np.int64)
+
+    if centroids is None:
+        n_clusters = int(codes.max()) + 1 if len(codes) > 0 else 0
+        sums = np.zeros((n_clusters, data.shape[1]))
+        np.add.at(sums, codes, data)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            centroids = sums / np.bincount(codes, minlength=n_clusters)[:, None]
+    centroids = np.asarray(centroids, dtype=np.float64)
+    n_clusters = len(centroids)
+    sizes = np.bincount(codes, minlength=n_clusters).astype(np.float64)
+    present = sizes > 0
+    n_present = int(np.sum(present))
+
+    inertia = 0
+    own_distance_sum = np.zeros(n_clusters)
+    silhouette_sum = 0
+    for i1 in range(0, len(data), batch_size):
+        batch = data[i1:i1 + batch_size]
+        batch_codes = codes[i1:i1 + batch_size]
+        rows = np.arange(len(batch))
+
+        distances = np.sqrt(np.maximum(
+            np.sum(batch**2, axis=1)[:, None] - 2 * batch @ centroids.T + np.sum(centroids**2, axis=1)[None, :], 0))
+        a = distances[rows, batch_codes]
+        inertia += np.sum(a**2)
+        own_distance_sum += np.bincount(batch_codes, weights=a, minlength=n_clusters)
+
+        distances[:, ~present] = np.inf
+        distances[rows, batch_codes] = np.inf
+        b = np.min(distances, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            silhouette_sum += np.sum(np.nan_to_num((b - a) / np.maximum(a, b)))
+
+    metrics = dict(inertia=inertia, silhouette=np.nan, calinski_harabasz=np.nan, davies_bouldin=np.nan)
+    if n_present < 2 or n_present >= len(data):
+        return metrics
+
+    metrics['silhouette'] = silhouette_sum / len(data)
+
+    center = data.mean(axis=0)
+    between = np.sum(sizes[present] * np.sum((centroids[present] - center)**2, axis=1))
+    metrics['calinski_harabasz'] = between * (len(data) - n_present) / (inertia * (n_present - 1)) \
+        if inertia > 0 else np.inf
+
+    scatter = own_distance_sum[present] / sizes[present]
+    c = centroids[present]
+    separation = np.sqrt(np.maximum(
+        np.sum(c**2, axis=1)[:, None] - 2 * c @ c.T + np.sum(c**2, axis=1)[None, :], 0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        similarity = (scatter[:, None] + scatter[None, :]) / separation
+    np.fill_diagonal(similarity, -np.inf)
+    metrics['davies_bouldin'] = np.mean(np.max(similarity, axis=1))
+
+    return metrics
+
+
+def sweep_metrics(data=None, models=None):
+    '''
+    Evaluates centroid_metrics for a list of fitted models (e.g. kmeans for different numbers of
+    clusters) and returns a dictionary with one list per metric, in the order of the models.
+
+    data:   data the models were fitted on
+    models: fitted models with labels_ (and cluster_centers_ if available)
+    '''
+    results = dict(inertia=[], silhouette=[], calinski_harabasz=[], davies_bouldin=[])
+    for model in models:
+        metrics = centroid_metrics(data=getattr(model, 'reduced_data_', data), labels=model.labels_,
+                                   centroids=getattr(model, 'cluster_centers_', None))
+        for key in results:
+            results[key].append(metrics[key])
+    return results
+
+
+def inertia_curvature(inertiaVals):
+    '''
+    Second derivative of the inertias of consecutive numbers of clusters (used by the elbow method)
+    '''
+    inertia = np.asarray(inertiaVals, dtype=np.float64)
+    return inertia[2:] - 2*inertia[1:-1] + inertia[0:-2]
+
+
 def elbowPlot(inertiaVals, n_cluster):
     '''
     Plots the values of the inertis computed by clustering, to be analysed through the elbow method
     '''
 
-    if isinstance(inertiaVals,list):
-        inertia = np.array(inertiaVals)
-    else:
-        inertia = inertiaVals
-
-    derivative2 = inertia[2:] -2*inertia[1:-1] + inertia[0:-2]
+    derivative2 = inertia_curvature(inertiaVals)
 
     fig = plt.figure(figsize = (8,5))
     plt.plot(n_cluster,inertiaVals, label = '$J$')
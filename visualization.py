@@ -361,7 +361,8 @@ class TimeSeries():
             self.d = d
 
     def createAnimation(self, number_of_contour_levels=10, n_rows=2, n_cols=2,
-                        max_data_value=None, min_data_value=None, start_frame=None, end_frame=None, skip_frames=None):
+                        max_data_value=None, min_data_value=None, start_frame=None, end_frame=None, skip_frames=None,
+                        stats=None):
         '''
         Create animation with the data given at init
 
@@ -373,6 +374,8 @@ class TimeSeries():
         start_frame:                Start from frame number e.g. 0
         end_frame:                  Start from frame number e.g. len(labels[:,0,0])
         skip_frames:                Amount of frames -1 to skip between every displayed image e.g. 1 (no skipping)
+        stats:                      List with the RunningStats of each data set (see running_stats.cached_stats).
+                                    If given, the automatic scaling uses them instead of scanning the data.
         '''
 
         # Check on given input
@@ -394,10 +397,16 @@ class TimeSeries():
 
         # For automatic scaling (Not recommended...)
         if max_data_value is None:
-            max_data_value = [np.max(dataSet) for dataSet in self.data]
+            if stats is None:
+                max_data_value = [np.max(dataSet) for dataSet in self.data]
+            else:
+                max_data_value = [np.nanmax(s.maximum) for s in stats]
         if min_data_value is None:
-            min_data_value = [np.max((0, np.min(dataSet)))
-                              for dataSet in self.data]
+            if stats is None:
+                min_data_value = [np.max((0, np.min(dataSet)))
+                                  for dataSet in self.data]
+            else:
+                min_data_value = [np.max((0, np.nanmin(s.minimum))) for s in stats]
 
         # Figure setup
         fig, axis = plt.subplots(nrows=n_rows, ncols=n_cols, sharex=True, sharey=True,